@@ -12,8 +12,11 @@ with open("SAROP21-PBPS133_proc.json") as config_file:
 
 pc.save_pipeline_config(pipeline_name, config)
 
-# update process func
+# update process func and the helper modules it imports
 filename = "../functions/pbps.py"
+helpers = ["../functions/pipeline_workers.py", "../functions/pv_publisher.py"]
+for helper in helpers:
+    pc.upload_user_script(helper)
 try:
     pc.set_function_script(instance_name, filename)
 except:
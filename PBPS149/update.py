@@ -12,8 +12,11 @@ with open("/sf/photo/pipeline_cam_server/PBPS149/SAROP31-PBPS149.json") as confi
 
 pc.save_pipeline_config(pipeline_name, config)
 
-# update process func
+# update process func and the helper modules it imports
 filename = "/sf/photo/pipeline_cam_server/functions/pbps.py"
+helpers = ["/sf/photo/pipeline_cam_server/functions/pipeline_workers.py", "/sf/photo/pipeline_cam_server/functions/pv_publisher.py"]
+for helper in helpers:
+    pc.upload_user_script(helper)
 try:
     pc.set_function_script(instance_name, filename)
 except:
@@ -1,78 +1,92 @@
+from collections import namedtuple
 from logging import getLogger
-
-from cam_server.pipeline.data_processing import functions
-from cam_server.utils import create_thread_pvs, epics_lock
-
+from threading import Lock
 
 import json
+import time
 
 import numpy
-import scipy.signal
-import scipy.optimize
-import numba
 
-numba.set_num_threads(4)
+import auto_roi
+import cpu_budget
+import dark_background
+import frame_context
+import pv_publisher
+import spectral_fit
+import spectral_shear
+import spectrometer_pvs
+import spectrum_kernels
+from spectrum_kernels import (image_moments, project_roi_moments, project_roi_sheared, project_roi_sheared_clamped,
+                              read_only, row_profile, savgol_smooth)
 
 _logger = getLogger(__name__)
 
-channel_names = None
-output_pv, center_pv, fwhm_pv, ymin_pv, ymax_pv, axis_pv = None, None, None, None, None, None
-roi = [0, 0]
-initialized = False
-sent_pid = -1
-
-
-@numba.njit(parallel=True)
-def get_spectrum(image, background):
-    y = image.shape[0]
-    x = image.shape[1]
-
-    profile = numpy.zeros(x, dtype=numpy.uint32)
-
-    for i in numba.prange(y):
-        for j in range(x):
-            v = image[i, j]
-            b = background[i, j]
-            if v > b:
-                v -= b
-            else:
-                v = 0
-            profile[j] += v
-    return profile
+# set once by the first frame and never modified, processing threads only read it
+PipelineSetup = namedtuple("PipelineSetup", ["channel_names", "pv_cache", "publisher", "auto_roi", "shear", "cpu",
+                                             "startup_time", "dark"])
+setup = None
+init_lock = Lock()
 
 
 def initialize(parameters):
-    global ymin_pv, ymax_pv, axis_pv, output_pv, center_pv, fwhm_pv
-    global channel_names
     epics_pv_name_prefix = parameters["camera_name"]
     output_pv_name = epics_pv_name_prefix + ":SPECTRUM_Y"
     center_pv_name = epics_pv_name_prefix + ":SPECTRUM_CENTER"
     fwhm_pv_name = epics_pv_name_prefix + ":SPECTRUM_FWHM"
-    ymin_pv_name = epics_pv_name_prefix + ":SPC_ROI_YMIN"
-    ymax_pv_name = epics_pv_name_prefix + ":SPC_ROI_YMAX"
-    axis_pv_name = epics_pv_name_prefix + ":SPECTRUM_X"
-    channel_names = [output_pv_name, center_pv_name, fwhm_pv_name, ymin_pv_name, ymax_pv_name, axis_pv_name]
+    channel_names = [output_pv_name, center_pv_name, fwhm_pv_name]
+
+    start = time.time()
+    # energy axis and ROI are monitored, frames only read the latest snapshot
+    pv_cache = spectrometer_pvs.get_pv_cache(epics_pv_name_prefix)
+    # EPICS outputs are put by the publisher thread, newest pulse first, so that slow Channel Access
+    # never stalls the processing threads
+    publisher = pv_publisher.get_publisher(parameters.get("publish_interval", 0.1), parameters.get("max_put_rate"))
+    # per row shifts that straighten tilted or curved spectral lines, from spectral_shear.py
+    shear = spectral_shear.load_shear_map(parameters["shear_map"]) if parameters.get("shear_map") else None
+    cpu = cpu_budget.allocate(parameters.get("name", epics_pv_name_prefix), parameters.get("processing_threads", 1))
+
+    # background averaged online from the dark shots flagged in bsdata, replaces the stored background
+    dark = dark_background.from_parameters(parameters)
+    roi_finder = auto_roi.from_parameters(parameters)
+
+    # load the compiled kernels from the numba cache, or compile them, before the first frame is processed.
+    # only the kernels and frame types of this config, each one takes seconds to compile on a cold cache.
+    # stored backgrounds are expected as float32 like the online one, other types compile on first use
+    kernels = [project_roi_moments]
+    if shear is not None:
+        kernels += [project_roi_sheared, project_roi_sheared_clamped]
+    if roi_finder is not None:
+        kernels.append(row_profile)
+    # frames have no background without a stored one, or before the first dark shot with the online one
+    background_dtypes = (None,) if dark is None else (None, numpy.float32)
+    if dark is None and parameters.get("image_background_enable"):
+        background_dtypes = (numpy.float32,)
+    spectrum_kernels.warm_up(kernels, background_dtypes=background_dtypes, pedestals=(0.0,))
+    spectral_fit.warm_up()
+    if dark is not None:
+        dark_background.warm_up()
+    startup_time = time.time() - start
+    _logger.info("Pipeline %s initialized in %.3f s", parameters.get("name", epics_pv_name_prefix), startup_time)
+
+    return PipelineSetup(channel_names, pv_cache, publisher, roi_finder, shear, cpu, startup_time,
+                         dark)
 
 
 def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata=None, background=None):
-    global roi, initialized, sent_pid
-    global channel_names
-    
-    if not initialized:
-        initialize(parameters)
-        initialized = True
-    [output_pv, center_pv, fwhm_pv, ymin_pv, ymax_pv, axis_pv] = create_thread_pvs(channel_names)
+    global setup
+
+    if setup is None:
+        with init_lock:
+            if setup is None:
+                setup = initialize(parameters)
+    pipeline = setup
+    context = frame_context.get_context(__name__)
+    cpu_budget.apply(pipeline.cpu)
     processed_data = dict()
     epics_pv_name_prefix = parameters["camera_name"]
 
-    if ymin_pv and ymin_pv.connected:
-        roi[0] = ymin_pv.value
-    if ymax_pv and ymax_pv.connected:
-        roi[1] = ymax_pv.value
-    if axis_pv and axis_pv.connected:
-        axis = axis_pv.value
-    else:
-        axis = None
+    settings = pipeline.pv_cache.snapshot
+    axis, roi = settings.axis, settings.roi
 
     if axis is None:
         _logger.warning("Energy axis not connected");
@@ -85,40 +99,79 @@ def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata
     # match the energy axis to image width
     axis = axis[:image.shape[1]]
 
+    # the kernels are compiled for read-only frames and backgrounds
+    image = read_only(image)
     processing_image = image
     #processing_image = image.astype(np.float32) - np.float32(parameters["pixel_bkg"])
 
     nrows, ncols = processing_image.shape
 
+    # follow the illuminated band instead of the ROI PVs, if enabled
+    if pipeline.auto_roi is not None:
+        if pipeline.auto_roi.due():
+            pipeline.auto_roi.update(image)
+        if pipeline.auto_roi.roi is not None:
+            roi = pipeline.auto_roi.roi
+
     # validate background data if passive mode (background subtraction handled here)
     background_image = parameters.pop('background_data', None)
+    background_id = parameters.get('image_background')
+    dark_shot = False
+    if pipeline.dark is not None:
+        # the online background of the dark shots replaces the stored one
+        dark_shot = dark_background.is_dark(bsdata, parameters)
+        if dark_shot:
+            pipeline.dark.update(image)
+        version, background_image = pipeline.dark.snapshot or (None, None)
+        background_id = ("online", version)
     if isinstance(background_image, numpy.ndarray):
         if background_image.shape != processing_image.shape:
             _logger.info("Invalid background shape: %s instead of %s" % (
             str(background_image.shape), str(processing_image.shape)))
             background_image = None
+        else:
+            background_image = read_only(background_image)
     else:
         background_image = None
 
     processed_data[epics_pv_name_prefix + ":processing_parameters"] = json.dumps(
-        {"roi": roi, "background": None if (background_image is None) else parameters.get('image_background')})
+        {"roi": roi, "settings_version": settings.version, "cpu": pipeline.cpu._asdict(), "startup_time": pipeline.startup_time, "background": None if (background_image is None) else background_id,
+         "dark_frames": None if (pipeline.dark is None) else pipeline.dark.count})
 
     # crop the image in y direction
     ymin, ymax = int(roi[0]), int(roi[1])
-    if nrows >= ymax > ymin >= 0:
-        if (nrows != ymax) or (ymin != 0):
-            processing_image = processing_image[ymin: ymax, :]
-            if background_image is not None:
-                background_image = background_image[ymin:ymax, :]
-
-    # remove the background and collapse in y direction to get the spectrum
-    if background_image is not None:
-        spectrum = get_spectrum(processing_image, background_image)
+    if not nrows >= ymax > ymin >= 0:
+        ymin, ymax = 0, nrows
+    if (nrows != ymax) or (ymin != 0):
+        processing_image = processing_image[ymin: ymax, :]
+        if background_image is not None:
+            background_image = background_image[ymin:ymax, :]
+
+    shear = spectral_shear.shear_for_frame(pipeline.shear, nrows)
+
+    # x and y profiles and the moments of the background subtracted ROI, in one pass over the frame
+    x_profile = numpy.empty(ncols, dtype=numpy.float64)
+    y_profile = numpy.empty(ymax - ymin, dtype=numpy.float64)
+    row_moments = context.buffer("row_moments", y_profile.shape)
+    project_roi_moments(processing_image, background_image, 0, ymax - ymin, x_profile, y_profile, row_moments)
+    intensity, centroid_x, centroid_y, sigma_x, sigma_y, tilt = image_moments(x_profile, y_profile, row_moments, ymin)
+
+    # the spectrum is the x profile, unless the spectral lines are straightened with the shear map.
+    # the sheared projection is a second pass over the ROI, so enabling shear more than doubles the
+    # projection time, the moments stay those of the unsheared frame
+    if shear is not None:
+        shift_int, shift_frac = shear[0][ymin:ymax], shear[1][ymin:ymax]
+        spectrum = numpy.empty(ncols, dtype=numpy.float64)
+        if background_image is not None:
+            project_roi_sheared_clamped(processing_image, background_image, 0, ymax - ymin, shift_int, shift_frac,
+                                        spectrum)
+        else:
+            project_roi_sheared(processing_image, 0, ymax - ymin, 0.0, shift_int, shift_frac, spectrum)
     else:
-        spectrum = processing_image.sum(0, 'uint32')
+        spectrum = x_profile
 
     # smooth the spectrum with savgol filter with 51 window size and 3rd order polynomial
-    smoothed_spectrum = scipy.signal.savgol_filter(spectrum, 51, 3)
+    smoothed_spectrum = savgol_smooth(spectrum, context.buffer("smoothed", spectrum.shape))
 
     # check wether spectrum has only noise. the average counts per pixel at the peak
     # should be larger than 1.5 to be considered as having real signals.
@@ -127,8 +180,8 @@ def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata
     skip = True
     if amplitude > nrows * 1.5:
         skip = False
-    # gaussian fitting
-    offset, amplitude, center, sigma = functions.gauss_fit_psss(smoothed_spectrum[::2], axis[::2],
+    # gaussian fitting, the errors are nan for skipped fits
+    offset, amplitude, center, sigma, perr = spectral_fit.gauss_fit(smoothed_spectrum[::2], axis[::2],
             offset=minimum, amplitude=amplitude, skip=skip, maxfev=20)
 
     # outputs
@@ -136,21 +189,26 @@ def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata
     processed_data[epics_pv_name_prefix + ":SPECTRUM_X"] = axis
     processed_data[epics_pv_name_prefix + ":SPECTRUM_CENTER"] = numpy.float64(center) 
     processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM"] = numpy.float64(2.355 * sigma) 
-    if epics_lock.acquire(False):
-            try:
-                if pulse_id > sent_pid:
-                    sent_pid = pulse_id
-                    if output_pv and output_pv.connected:
-                        output_pv.put(processed_data[epics_pv_name_prefix + ":SPECTRUM_Y"])
-                        #_logger.debug("caput on %s for pulse_id %s", output_pv, pulse_id)
-
-                    if center_pv and center_pv.connected:
-                        center_pv.put(processed_data[epics_pv_name_prefix + ":SPECTRUM_CENTER"])
-
-                    if fwhm_pv and fwhm_pv.connected:
-                        fwhm_pv.put(processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM"])
-            finally:
-                epics_lock.release()
+    processed_data[epics_pv_name_prefix + ":SPECTRUM_CENTER_ERR"] = numpy.float64(perr[2])
+    processed_data[epics_pv_name_prefix + ":SPECTRUM_FWHM_ERR"] = numpy.float64(2.355 * perr[3])
+    processed_data[epics_pv_name_prefix + ":SPECTRUM_ROI_YMIN"] = numpy.int32(ymin)
+    processed_data[epics_pv_name_prefix + ":SPECTRUM_ROI_YMAX"] = numpy.int32(ymax)
+    processed_data[epics_pv_name_prefix + ":PROFILE_Y"] = y_profile
+    processed_data[epics_pv_name_prefix + ":IMAGE_INTENSITY"] = numpy.float64(intensity)
+    processed_data[epics_pv_name_prefix + ":IMAGE_CENTROID_X"] = numpy.float64(centroid_x)
+    processed_data[epics_pv_name_prefix + ":IMAGE_CENTROID_Y"] = numpy.float64(centroid_y)
+    processed_data[epics_pv_name_prefix + ":IMAGE_SIGMA_X"] = numpy.float64(sigma_x)
+    processed_data[epics_pv_name_prefix + ":IMAGE_SIGMA_Y"] = numpy.float64(sigma_y)
+    processed_data[epics_pv_name_prefix + ":IMAGE_TILT"] = numpy.float64(tilt)
+    processed_data[epics_pv_name_prefix + ":DARK_SHOT"] = numpy.int32(dark_shot)
+
+    # dark shots only feed the online background, the EPICS outputs keep the last spectrum with beam
+    if not dark_shot:
+        pipeline.publisher.put_many({name: processed_data[name] for name in pipeline.channel_names}, pulse_id)
+    stats = pipeline.publisher.stats()
+    processed_data[epics_pv_name_prefix + ":PV_PUT_LATENCY"] = stats["latency"]
+    processed_data[epics_pv_name_prefix + ":PV_PUT_DROPPED"] = stats["dropped"]
+    processed_data[epics_pv_name_prefix + ":PV_PUT_COALESCED"] = stats["coalesced"]
 
     return processed_data
 
@@ -13,8 +13,22 @@ with open("PMOS132-2D.json") as config_file:
 
 pc.save_pipeline_config(pipeline_name, config)
 
-# update process func
+# update process func and the helper modules it imports
 filename = "pmos132-2D.py"
+helpers = [
+    "../functions/spectral_fit.py",
+    "../functions/spectrometer_pvs.py",
+    "../functions/spectrum_kernels.py",
+    "../functions/frame_context.py",
+    "../functions/pipeline_workers.py",
+    "../functions/pv_publisher.py",
+    "../functions/auto_roi.py",
+    "../functions/spectral_shear.py",
+    "../functions/cpu_budget.py",
+    "../functions/dark_background.py",
+]
+for helper in helpers:
+    pc.upload_user_script(helper)
 try:
     pc.set_function_script(instance_name, filename)
 except:
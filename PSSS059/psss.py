@@ -1,75 +1,122 @@
+from collections import namedtuple
 from logging import getLogger
-
-from cam_server.pipeline.data_processing import functions
-from cam_server.utils import create_thread_pvs, epics_lock
-
+from threading import Lock
 
 import json
+import time
 
 import numpy as np
-import scipy.signal
-import scipy.optimize
-import numba
 
-numba.set_num_threads(4)
+import auto_roi
+import cpu_budget
+import dark_background
+import frame_context
+import pv_publisher
+import sase_spikes
+import spectral_fit
+import spectral_shear
+import spectrometer_pvs
+import spectrum_kernels
+from spectrum_kernels import project_roi, project_roi_sheared, read_only, row_profile, savgol_smooth
 
 _logger = getLogger(__name__)
 
-channel_names = None
-output_pv, center_pv, fwhm_pv, ymin_pv, ymax_pv, axis_pv = None, None, None, None, None, None
-roi = [0, 0]
-initialized = False
-sent_pid = -1
-nrows = 1
-axis = None
+# set once by the first frame and never modified, processing threads only read it
+PipelineSetup = namedtuple("PipelineSetup", ["channel_names", "pv_cache", "publisher", "auto_roi", "shear", "cpu",
+                                             "startup_time", "dark"])
+setup = None
+init_lock = Lock()
+
+
+class BackgroundProjectionCache:
+    """Column sums of the background ROI, recomputed only when the background or the ROI changes.
+
+    Without clamping, the projection of (image - background) is the image projection minus the
+    background projection, so background subtraction costs O(width) per frame. This also holds for
+    the sheared projection, as long as both use the same shear tables.
+    """
 
-@numba.njit(parallel=False)
-def get_spectrum(image, background):
-    y = image.shape[0]
-    x = image.shape[1]
+    def __init__(self):
+        # (key, projection), replaced as a whole so that readers never see a half updated entry
+        self._entry = None
 
-    profile = np.zeros(x, dtype=np.float64)
+    def get(self, background_id, background, ymin, ymax, shear=None):
+        key = (background_id, background.shape, ymin, ymax, None if shear is None else id(shear))
+        entry = self._entry
+        if entry is not None and entry[0] == key:
+            return entry[1]
 
-    for i in numba.prange(y):
-        for j in range(x):
-            profile[j] += image[i, j] - background[i, j]
-    return profile
+        projection = np.empty(background.shape[1], dtype=np.float64)
+        if shear is not None:
+            project_roi_sheared(background, ymin, ymax, 0.0, *shear, projection)
+        else:
+            project_roi(background, ymin, ymax, 0.0, projection)
+        projection.flags.writeable = False
+        self._entry = (key, projection)
+        return projection
+
+
+background_cache = BackgroundProjectionCache()
 
 
 def initialize(params):
-    global ymin_pv, ymax_pv, axis_pv, output_pv, center_pv, fwhm_pv
-    global channel_names, spectra_buffer
     camera_name = params["camera_name"]
     output_pv_name = camera_name + ":SPECTRUM_Y"
     center_pv_name = camera_name + ":SPECTRUM_CENTER"
     fwhm_pv_name = camera_name + ":SPECTRUM_FWHM"
-    ymin_pv_name = camera_name + ":SPC_ROI_YMIN"
-    ymax_pv_name = camera_name + ":SPC_ROI_YMAX"
-    axis_pv_name = camera_name + ":SPECTRUM_X"
     com_pv_name = camera_name + ":SPECTRUM_COM"
     std_pv_name = camera_name + ":SPECTRUM_STD"
-    channel_names = [output_pv_name, center_pv_name, fwhm_pv_name, ymin_pv_name, ymax_pv_name, axis_pv_name, com_pv_name, std_pv_name]
+    channel_names = [output_pv_name, center_pv_name, fwhm_pv_name, com_pv_name, std_pv_name]
+
+    start = time.time()
+    # energy axis and ROI are monitored, frames only read the latest snapshot
+    pv_cache = spectrometer_pvs.get_pv_cache(camera_name)
+    # EPICS outputs are put by the publisher thread, newest pulse first, so that slow Channel Access
+    # never stalls the processing threads
+    publisher = pv_publisher.get_publisher(params.get("publish_interval", 0.1), params.get("max_put_rate"))
+    # per row shifts that straighten tilted or curved spectral lines, from spectral_shear.py
+    shear = spectral_shear.load_shear_map(params["shear_map"]) if params.get("shear_map") else None
+    cpu = cpu_budget.allocate(params.get("name", camera_name), params.get("processing_threads", 1))
+
+    # background averaged online from the dark shots flagged in bsdata, replaces the stored background
+    dark = dark_background.from_parameters(params)
+    roi_finder = auto_roi.from_parameters(params)
+
+    # load the compiled kernels from the numba cache, or compile them, before the first frame is processed.
+    # only the kernels and frame types of this config, each one takes seconds to compile on a cold cache.
+    # stored backgrounds are expected as float32 like the online one, other types compile on first use
+    kernels = [project_roi_sheared if shear is not None else project_roi]
+    if dark is not None or params.get("image_background_enable"):
+        # the cached background projection runs the same kernel with the background as frame
+        spectrum_kernels.warm_up(kernels, image_dtypes=(np.float32,), pedestals=(0.0,))
+    if roi_finder is not None:
+        kernels.append(row_profile)
+    spectrum_kernels.warm_up(kernels, pedestals=(params.get("pixel_bkg", 0),))
+    spectral_fit.warm_up()
+    if dark is not None:
+        dark_background.warm_up()
+    startup_time = time.time() - start
+    _logger.info("Pipeline %s initialized in %.3f s", params.get("name", camera_name), startup_time)
+
+    return PipelineSetup(channel_names, pv_cache, publisher, roi_finder, shear, cpu, startup_time,
+                         dark)
 
 
 def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata=None, background=None):
-    global roi, initialized, sent_pid, nrows, axis
-    global channel_names
-
-    if not initialized:
-        initialize(parameters)
-        initialized = True
-    [output_pv, center_pv, fwhm_pv, ymin_pv, ymax_pv, axis_pv, com_pv, std_pv] = create_thread_pvs(channel_names)
+    global setup
+
+    if setup is None:
+        with init_lock:
+            if setup is None:
+                setup = initialize(parameters)
+    pipeline = setup
+    context = frame_context.get_context(__name__)
+    cpu_budget.apply(pipeline.cpu)
     processed_data = dict()
     camera_name = parameters["camera_name"]
 
-    if ymin_pv and ymin_pv.connected:
-        roi[0] = ymin_pv.value
-    if ymax_pv and ymax_pv.connected:
-        roi[1] = ymax_pv.value
-    if axis_pv and axis_pv.connected:
-        axis = axis_pv.value
-    else:
-        axis = None
+    settings = pipeline.pv_cache.snapshot
+    axis, roi = settings.axis, settings.roi
 
     if axis is None:
         _logger.warning("Energy axis not connected");
@@ -82,39 +129,62 @@ def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata
     # match the energy axis to image width
     axis = axis[:image.shape[1]]
 
-    processing_image = image.astype(np.float32) - np.float32(parameters["pixel_bkg"])
-    nrows, ncols = processing_image.shape
+    # the kernels are compiled for read-only frames and backgrounds
+    image = read_only(image)
+    nrows, ncols = image.shape
+
+    # follow the illuminated band instead of the ROI PVs, if enabled
+    if pipeline.auto_roi is not None:
+        if pipeline.auto_roi.due():
+            pipeline.auto_roi.update(image)
+        if pipeline.auto_roi.roi is not None:
+            roi = pipeline.auto_roi.roi
 
     # validate background data if passive mode (background subtraction handled here)
     background_image = parameters.pop('background_data', None)
+    background_id = parameters.get('image_background')
+    dark_shot = False
+    if pipeline.dark is not None:
+        # the online background of the dark shots replaces the stored one
+        dark_shot = dark_background.is_dark(bsdata, parameters)
+        if dark_shot:
+            pipeline.dark.update(image)
+        version, background_image = pipeline.dark.snapshot or (None, None)
+        background_id = ("online", version)
     if isinstance(background_image, np.ndarray):
-        background_image = background_image.astype(np.float32)
-        if background_image.shape != processing_image.shape:
+        if background_image.shape != image.shape:
             _logger.info("Invalid background shape: %s instead of %s" % (
-            str(background_image.shape), str(processing_image.shape)))
+            str(background_image.shape), str(image.shape)))
             background_image = None
+        else:
+            background_image = read_only(background_image)
     else:
         background_image = None
 
     processed_data[camera_name + ":processing_parameters"] = json.dumps(
-        {"roi": roi, "background": None if (background_image is None) else parameters.get('image_background')})
+        {"roi": roi, "settings_version": settings.version, "cpu": pipeline.cpu._asdict(), "startup_time": pipeline.startup_time,
+         "background": None if (background_image is None) else background_id,
+         "dark_frames": None if (pipeline.dark is None) else pipeline.dark.count})
 
     # crop the image in y direction
     ymin, ymax = int(roi[0]), int(roi[1])
-    if nrows >= ymax > ymin >= 0:
-        if (nrows != ymax) or (ymin != 0):
-            processing_image = processing_image[ymin: ymax, :]
-            if background_image is not None:
-                background_image = background_image[ymin:ymax, :]
-
-    # remove the background and collapse in y direction to get the spectrum
-    if background_image is not None:
-        spectrum = get_spectrum(processing_image, background_image)
+    if not nrows >= ymax > ymin >= 0:
+        ymin, ymax = 0, nrows
+
+    # remove the pedestal and collapse the ROI in y direction to get the spectrum, in a single pass
+    # over the raw frame, then remove the cached projection of the background. the spectrum is part
+    # of the output, all other arrays of the frame are scratch buffers of this thread
+    spectrum = np.empty(ncols, dtype=np.float64)
+    shear = spectral_shear.shear_for_frame(pipeline.shear, nrows)
+    if shear is not None:
+        project_roi_sheared(image, ymin, ymax, parameters["pixel_bkg"], *shear, spectrum)
     else:
-        spectrum = np.sum(processing_image, axis=0)
+        project_roi(image, ymin, ymax, parameters["pixel_bkg"], spectrum)
+    if background_image is not None:
+        spectrum -= background_cache.get(background_id or id(background_image), background_image, ymin, ymax, shear)
 
     # smooth the spectrum with savgol filter with 51 window size and 3rd order polynomial
-    smoothed_spectrum = scipy.signal.savgol_filter(spectrum, 51, 3)
+    smoothed_spectrum = savgol_smooth(spectrum, context.buffer("smoothed", spectrum.shape))
 
     # check wether spectrum has only noise. the average counts per pixel at the peak
     # should be larger than 1.5 to be considered as having real signals.
@@ -123,42 +193,42 @@ def process_image(image, pulse_id, timestamp, x_axis, y_axis, parameters, bsdata
     skip = True
     if amplitude > nrows * 1.5:
         skip = False
-    # gaussian fitting
-    offset, amplitude, center, sigma = functions.gauss_fit_psss(smoothed_spectrum[::2], axis[::2],
+    # gaussian fitting, the errors are nan for skipped fits
+    offset, amplitude, center, sigma, perr = spectral_fit.gauss_fit(smoothed_spectrum[::2], axis[::2],
             offset=minimum, amplitude=amplitude, skip=skip, maxfev=20)
 
-    smoothed_spectrum_normed = smoothed_spectrum / np.sum(smoothed_spectrum)
-    spectrum_com = np.sum(axis * smoothed_spectrum_normed)
-    spectrum_std = np.sqrt(np.sum((axis - spectrum_com) ** 2 * smoothed_spectrum_normed))
+    # single-shot spike analysis, spikes are found on the smoothed and measured on the unsmoothed spectrum
+    spike_count, spike_positions, spike_widths, correlation_width = sase_spikes.analyse_spikes(
+        spectrum, smoothed_spectrum, axis, parameters.get("spike_prominence", 0.1), parameters.get("max_spikes", 32))
+
+    total = np.sum(smoothed_spectrum)
+    spectrum_com = np.dot(axis, smoothed_spectrum) / total
+    deviation = np.subtract(axis, spectrum_com, out=context.buffer("deviation", axis.shape))
+    spectrum_std = np.sqrt(np.dot(np.square(deviation, out=deviation), smoothed_spectrum) / total)
 
     # outputs
     processed_data[camera_name + ":SPECTRUM_Y"] = spectrum
     processed_data[camera_name + ":SPECTRUM_X"] = axis
     processed_data[camera_name + ":SPECTRUM_CENTER"] = np.float64(center)
     processed_data[camera_name + ":SPECTRUM_FWHM"] = np.float64(2.355 * sigma)
+    processed_data[camera_name + ":SPECTRUM_CENTER_ERR"] = np.float64(perr[2])
+    processed_data[camera_name + ":SPECTRUM_FWHM_ERR"] = np.float64(2.355 * perr[3])
+    processed_data[camera_name + ":SPECTRUM_ROI_YMIN"] = np.int32(ymin)
+    processed_data[camera_name + ":SPECTRUM_ROI_YMAX"] = np.int32(ymax)
     processed_data[camera_name + ":SPECTRUM_COM"] = spectrum_com
     processed_data[camera_name + ":SPECTRUM_STD"] = spectrum_std
-
-
-    if epics_lock.acquire(False):
-        try:
-            if pulse_id > sent_pid:
-                sent_pid = pulse_id
-                if output_pv and output_pv.connected:
-                    output_pv.put(processed_data[camera_name + ":SPECTRUM_Y"])
-
-                if center_pv and center_pv.connected:
-                    center_pv.put(processed_data[camera_name + ":SPECTRUM_CENTER"])
-
-                if fwhm_pv and fwhm_pv.connected:
-                    fwhm_pv.put(processed_data[camera_name + ":SPECTRUM_FWHM"])
-
-                if com_pv and com_pv.connected:
-                    com_pv.put(processed_data[camera_name + ":SPECTRUM_COM"])
-
-                if std_pv and std_pv.connected:
-                    std_pv.put(processed_data[camera_name + ":SPECTRUM_STD"])
-        finally:
-            epics_lock.release()
+    processed_data[camera_name + ":SPECTRUM_SPIKE_COUNT"] = np.int32(spike_count)
+    processed_data[camera_name + ":SPECTRUM_SPIKE_POSITIONS"] = spike_positions
+    processed_data[camera_name + ":SPECTRUM_SPIKE_WIDTHS"] = spike_widths
+    processed_data[camera_name + ":SPECTRUM_CORRELATION_WIDTH"] = np.float64(correlation_width)
+    processed_data[camera_name + ":DARK_SHOT"] = np.int32(dark_shot)
+
+    # dark shots only feed the online background, the EPICS outputs keep the last spectrum with beam
+    if not dark_shot:
+        pipeline.publisher.put_many({name: processed_data[name] for name in pipeline.channel_names}, pulse_id)
+    stats = pipeline.publisher.stats()
+    processed_data[camera_name + ":PV_PUT_LATENCY"] = stats["latency"]
+    processed_data[camera_name + ":PV_PUT_DROPPED"] = stats["dropped"]
+    processed_data[camera_name + ":PV_PUT_COALESCED"] = stats["coalesced"]
 
     return processed_data
@@ -1,13 +1,13 @@
-import time
 from collections import deque
 from logging import getLogger
-from threading import Thread
 
-from cam_server.pipeline.data_processing import functions
 from cam_server.utils import create_thread_pvs, epics_lock
 
 import numpy as np
 
+import pipeline_workers
+import spectral_fit
+
 _logger = getLogger(__name__)
 
 initialized = False
@@ -19,17 +19,16 @@ avg_fwhm = None
 spectra_buffer = None
 
 
-def update_avg_spectrum(y_pvname, m_pvname, w_pvname):
+def update_avg_spectrum(stop_event, y_pvname, m_pvname, w_pvname):
     global avg_spectrum, avg_center, avg_fwhm
     y_pv, m_pv, w_pv = create_thread_pvs([y_pvname, m_pvname, w_pvname])
     y_pv.wait_for_connection()
     m_pv.wait_for_connection()
     w_pv.wait_for_connection()
     if not (y_pv.connected and m_pv.connected and w_pv.connected):
-        raise (f"Cannot connect to PVs.")
+        raise RuntimeError("Cannot connect to PVs.")
 
-    while True:
-        time.sleep(1)
+    while not stop_event.wait(1):
         if len(spectra_buffer) != spectra_buffer.maxlen:
             continue
 
@@ -41,7 +40,7 @@ def update_avg_spectrum(y_pvname, m_pvname, w_pvname):
         if amplitude > nrows * 1.5:
             skip = False
         # gaussian fitting
-        offset, amplitude, center, sigma = functions.gauss_fit_psss(
+        offset, amplitude, center, sigma, _ = spectral_fit.gauss_fit(
             avg_spectrum[::2], axis[::2], offset=minimum, amplitude=amplitude, skip=skip, maxfev=20
         )
         avg_center = np.float64(center)
@@ -61,15 +60,16 @@ def initialize(params):
 
     camera_name = params["camera_name"]
     spectra_buffer = deque(maxlen=params["queue_length"])
-    thread = Thread(
-        target=update_avg_spectrum,
-        args=(
-            camera_name + ":SPECTRUM_AVG_Y",
-            camera_name + ":SPECTRUM_AVG_CENTER",
-            camera_name + ":SPECTRUM_AVG_FWHM",
-        ),
+
+    # stop the worker of a previously loaded version of this function before starting a new one
+    pipeline_workers.stop_workers(params["name"])
+    pipeline_workers.start_worker(
+        params["name"],
+        update_avg_spectrum,
+        camera_name + ":SPECTRUM_AVG_Y",
+        camera_name + ":SPECTRUM_AVG_CENTER",
+        camera_name + ":SPECTRUM_AVG_FWHM",
     )
-    thread.start()
 
 
 def process(data, pulse_id, timestamp, params):
@@ -90,5 +90,6 @@ def process(data, pulse_id, timestamp, params):
     processed_data[camera_name + ":SPECTRUM_AVG_Y"] = avg_spectrum
     processed_data[camera_name + ":SPECTRUM_AVG_CENTER"] = avg_center
     processed_data[camera_name + ":SPECTRUM_AVG_FWHM"] = avg_fwhm
+    processed_data[camera_name + ":LIVE_WORKERS"] = pipeline_workers.live_workers(params["name"])
 
     return processed_data
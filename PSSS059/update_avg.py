@@ -13,8 +13,11 @@ with open("PSSS_avg.json") as config_file:
 
 pc.save_pipeline_config(pipeline_name, config)
 
-# update process func
+# update process func and the helper modules it imports
 filename = "psss_avg.py"
+helpers = ["../functions/pipeline_workers.py", "../functions/spectral_fit.py"]
+for helper in helpers:
+    pc.upload_user_script(helper)
 try:
     pc.set_function_script(instance_name, filename)
 except:
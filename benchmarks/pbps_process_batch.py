@@ -0,0 +1,45 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+import pbps
+
+config_file = os.path.join(os.path.dirname(__file__), "..", "PBPS053", "SARFE10-PBPS053_proc.json")
+n_pulses = 1_000_000
+
+with open(config_file) as f:
+    params = json.load(f)
+
+# set up the device state without connecting to any PVs
+pbps.setup_devices(params)
+pbps.initialized = True
+pbps.publisher = pbps.pv_publisher.PVPublisher()
+
+rng = np.random.default_rng(0)
+data = {params[key]: rng.uniform(0, 2000, n_pulses) for key in ("up", "down", "left", "right")}
+pulse_ids = np.arange(n_pulses)
+
+start = time.perf_counter()
+output = pbps.process_batch(data, pulse_ids, params)
+elapsed = time.perf_counter() - start
+print(f"process_batch: {n_pulses / elapsed:.3g} pulses/s")
+
+start = time.perf_counter()
+pbps.process_batch(data, pulse_ids, params, update_buffers=True)
+elapsed = time.perf_counter() - start
+print(f"process_batch with buffer updates: {n_pulses / elapsed:.3g} pulses/s")
+
+# compare bit-for-bit with the per pulse function on a subset
+n_check = 10_000
+start = time.perf_counter()
+for i in range(n_check):
+    single = pbps.process({channel: float(values[i]) for channel, values in data.items()}, i, None, params)
+    for key, value in single.items():
+        if key in output and not np.array_equal(output[key][i], value, equal_nan=True):
+            raise AssertionError(f"{key} differs for pulse {i}: {output[key][i]!r} != {value!r}")
+elapsed = time.perf_counter() - start
+print(f"process: {n_check / elapsed:.3g} pulses/s, results identical for {n_check} pulses")
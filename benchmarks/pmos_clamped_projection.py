@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+
+import numba
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+from spectrum_kernels import project_roi_clamped, project_roi_moments
+
+nrows, ncols = 2160, 2560
+ymin, ymax = 0, nrows
+n_frames = 20
+n_checks = 20
+
+
+@numba.njit(parallel=True)
+def get_spectrum(image, background):
+    # kernel of the previous pmos132-2D.py implementation, all threads add into one profile
+    y = image.shape[0]
+    x = image.shape[1]
+
+    profile = np.zeros(x, dtype=np.uint32)
+
+    for i in numba.prange(y):
+        for j in range(x):
+            v = image[i, j]
+            b = background[i, j]
+            if v > b:
+                v -= b
+            else:
+                v = 0
+            profile[j] += v
+    return profile
+
+
+def serial_reference(image, background):
+    return np.maximum(image.astype(np.int64) - background.astype(np.int64), 0)[ymin:ymax].sum(axis=0)
+
+
+def blocked(image, background):
+    return project_roi_clamped(image, background, ymin, ymax, np.empty(ncols, dtype=np.float64))
+
+
+def moments(image, background):
+    # same pass, also accumulating the y profile and the moments of the 2D image
+    x_profile = np.empty(ncols, dtype=np.float64)
+    project_roi_moments(image, background, ymin, ymax, x_profile, np.empty(ymax - ymin), np.empty(ymax - ymin))
+    return x_profile
+
+
+rng = np.random.default_rng(0)
+background = rng.integers(90, 110, size=(nrows, ncols), dtype=np.uint16)
+frames = [rng.integers(0, 4096, size=(nrows, ncols), dtype=np.uint16) for _ in range(3)]
+
+print(f"numba threads: {numba.get_num_threads()}")
+mismatches = {"previous": 0, "blocked": 0, "moments": 0}
+for k in range(n_checks):
+    image = frames[k % len(frames)]
+    reference = serial_reference(image, background)
+    mismatches["previous"] += not np.array_equal(get_spectrum(image, background), reference)
+    mismatches["blocked"] += not np.array_equal(blocked(image, background), reference)
+    mismatches["moments"] += not np.array_equal(moments(image, background), reference)
+for name, count in mismatches.items():
+    print(f"{name:>8}: {count} of {n_checks} frames differ from the serial reference")
+
+for name, function in (("serial", serial_reference), ("previous", get_spectrum), ("blocked", blocked), ("moments", moments)):
+    function(frames[0], background)  # compile
+    start = time.perf_counter()
+    for k in range(n_frames):
+        function(frames[k % len(frames)], background)
+    print(f"{name:>8}: {(time.perf_counter() - start) / n_frames * 1e3:7.2f} ms/frame")
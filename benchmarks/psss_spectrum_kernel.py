@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+import tracemalloc
+
+import numba
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+from spectral_shear import shear_tables
+from spectrum_kernels import (
+    project_roi,
+    project_roi_background,
+    project_roi_sheared,
+    project_roi_sheared_clamped,
+)
+
+nrows, ncols = 2160, 2560
+ymin, ymax = 700, 1400
+pixel_bkg = 1
+n_frames = 50
+
+
+@numba.njit(parallel=False)
+def get_spectrum(image, background):
+    # kernel of the previous psss.py implementation
+    y = image.shape[0]
+    x = image.shape[1]
+
+    profile = np.zeros(x, dtype=np.float64)
+
+    for i in numba.prange(y):
+        for j in range(x):
+            profile[j] += image[i, j] - background[i, j]
+    return profile
+
+
+def previous_path(image, background_image):
+    processing_image = image.astype(np.float32) - np.float32(pixel_bkg)
+    if background_image is not None:
+        background_image = background_image.astype(np.float32)[ymin:ymax, :]
+    processing_image = processing_image[ymin:ymax, :]
+    if background_image is not None:
+        return get_spectrum(processing_image, background_image)
+    return np.sum(processing_image, axis=0)
+
+
+def fused_path(image, background_image):
+    spectrum = np.empty(ncols, dtype=np.float64)
+    if background_image is not None:
+        return project_roi_background(image, background_image, ymin, ymax, pixel_bkg, spectrum)
+    return project_roi(image, ymin, ymax, pixel_bkg, spectrum)
+
+
+background_projection = {}
+
+
+def cached_background_path(image, background_image):
+    # image projection minus the background projection, which psss.py computes once per background
+    spectrum = project_roi(image, ymin, ymax, pixel_bkg, np.empty(ncols, dtype=np.float64))
+    if background_image is not None:
+        if "projection" not in background_projection:
+            background_projection["projection"] = project_roi(background_image, ymin, ymax, 0.0, np.empty(ncols))
+        spectrum -= background_projection["projection"]
+    return spectrum
+
+
+def measure(function, image, background_image):
+    function(image, background_image)  # compile
+
+    start = time.perf_counter()
+    for _ in range(n_frames):
+        function(image, background_image)
+    elapsed = (time.perf_counter() - start) / n_frames
+
+    tracemalloc.start()
+    function(image, background_image)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+rng = np.random.default_rng(0)
+image = rng.integers(0, 4096, size=(nrows, ncols), dtype=np.uint16)
+background = rng.uniform(0, 10, size=(nrows, ncols))
+
+for label, background_image in (("without background", None), ("with background", background)):
+    reference = previous_path(image, background_image)
+    for name, function in (("fused", fused_path), ("cached", cached_background_path)):
+        result = function(image, background_image)
+        difference = np.max(np.abs(result - reference) / np.abs(reference))
+        print(f"{label}, {name}: max relative difference to previous {difference:.2e}")
+    paths = (("previous", previous_path), ("fused", fused_path), ("cached", cached_background_path))
+    for name, function in paths:
+        elapsed, peak = measure(function, image, background_image)
+        print(f"  {name:>9}: {elapsed * 1e3:7.2f} ms/frame, {peak / 2**20:7.2f} MiB allocated")
+
+# tilt and curvature correction, 100 Hz with 6 processing threads leaves 60 ms per frame
+shift_int, shift_frac = shear_tables(np.array([2e-5, -0.032, 11.5]), nrows)
+paths = (
+    ("sheared", lambda image, _: project_roi_sheared(image, ymin, ymax, pixel_bkg, shift_int, shift_frac, np.empty(ncols))),
+    ("sheared clamped", lambda image, background_image: project_roi_sheared_clamped(
+        image, background_image, ymin, ymax, shift_int, shift_frac, np.empty(ncols))),
+)
+for name, function in paths:
+    elapsed, peak = measure(function, image, background)
+    print(f"{name:>15}: {elapsed * 1e3:7.2f} ms/frame, {peak / 2**20:7.2f} MiB allocated")
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.signal
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+from sase_spikes import analyse_spikes
+
+# the PSSS pipeline runs at 100 Hz with 6 processing threads, so each thread has 60 ms per frame
+rate, threads = 100, 6
+budget = threads / rate
+n_spectra = 600
+n_spikes = 20
+spike_sigma = 0.15
+axis = np.linspace(9000, 9100, 2560)
+
+rng = np.random.default_rng(0)
+spectra = np.empty((n_spectra, len(axis)))
+for spectrum in spectra:
+    # random spikes under a gaussian SASE envelope, with pixel noise
+    centers = rng.normal(9050, 10, n_spikes)
+    heights = rng.exponential(1, n_spikes) * np.exp(-((centers - 9050) ** 2) / (2 * 10**2))
+    spectrum[:] = heights @ np.exp(-((axis - centers[:, None]) ** 2) / (2 * spike_sigma**2))
+    spectrum += rng.normal(0, 0.02, len(axis))
+# smoothed like psss.py does, spikes are found on the smoothed and measured on the unsmoothed spectra
+smoothed = scipy.signal.savgol_filter(spectra, 51, 3, axis=1)
+
+count, positions, widths, width = analyse_spikes(spectra[0], smoothed[0], axis)
+print(f"example: {count} spikes, median FWHM {np.nanmedian(widths):.3f}, correlation width {width:.3f}")
+all_widths = np.concatenate([analyse_spikes(spectrum, s, axis)[2] for spectrum, s in zip(spectra, smoothed)])
+print(f"median FWHM of all spectra {np.nanmedian(all_widths):.3f}, generated spike FWHM {2.355 * spike_sigma:.3f}")
+
+start = time.perf_counter()
+for spectrum, s in zip(spectra, smoothed):
+    analyse_spikes(spectrum, s, axis)
+single = (time.perf_counter() - start) / n_spectra
+print(f"single thread: {single * 1e3:.3f} ms/spectrum, {100 * single / budget:.2f} % of the per-frame budget")
+
+with ThreadPoolExecutor(threads) as executor:
+    start = time.perf_counter()
+    list(executor.map(lambda spectrum, s: analyse_spikes(spectrum, s, axis), spectra, smoothed))
+    elapsed = time.perf_counter() - start
+print(f"{threads} threads: {n_spectra / elapsed:.0f} spectra/s (needs {rate})")
@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+
+import numpy as np
+import scipy.optimize
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+from spectral_fit import gauss_fit, gauss_fit_many
+
+n_spectra = 200
+axis = np.linspace(11000, 11400, 1280)
+true_sigma = 30.0
+
+
+def _gauss_function(x, offset, amplitude, center, standard_deviation):
+    return offset + amplitude * np.exp(-((x - center) ** 2) / (2 * standard_deviation**2))
+
+
+def _gauss_deriv(x, offset, amplitude, center, standard_deviation):
+    fac = np.exp(-((x - center) ** 2) / (2 * standard_deviation**2))
+    result = np.empty((4, x.size), dtype=x.dtype)
+    result[0, :] = 1.0
+    result[1, :] = fac
+    result[2, :] = amplitude * fac * (x - center) / (standard_deviation**2)
+    result[3, :] = amplitude * fac * ((x - center) ** 2) / (standard_deviation**3)
+    return result
+
+
+def gauss_fit_psss(profile, axis, **kwargs):
+    # cam_server's implementation, used when cam_server is not installed
+    offset = kwargs.get("offset", profile.min())
+    amplitude = kwargs.get("amplitude", profile.max() - offset)
+    center = kwargs.get("center", np.dot(axis, profile) / profile.sum())
+    trapezoid = getattr(np, "trapezoid", None) or np.trapz
+    standard_deviation = kwargs.get(
+        "standard_deviation", trapezoid(profile - offset, x=axis) / (amplitude * np.sqrt(2 * np.pi))
+    )
+    try:
+        optimal_parameter, _ = scipy.optimize.curve_fit(
+            _gauss_function, axis, profile.astype("float64"), p0=[offset, amplitude, center, standard_deviation],
+            jac=_gauss_deriv, col_deriv=1, maxfev=kwargs.get("maxfev", 20),
+        )
+        offset, amplitude, center, standard_deviation = optimal_parameter
+    except BaseException:
+        pass
+    return offset, amplitude, center, abs(standard_deviation)
+
+
+try:
+    from cam_server.pipeline.data_processing.functions import gauss_fit_psss
+except ImportError:
+    pass
+
+
+rng = np.random.default_rng(0)
+centers = rng.normal(11200, 40, n_spectra)
+spectra = 50 + 1000 * np.exp(-((axis - centers[:, None]) ** 2) / (2 * true_sigma**2))
+spectra += rng.normal(0, 20, spectra.shape)
+
+
+def call(function, spectrum):
+    minimum = spectrum.min()
+    return function(spectrum, axis, offset=minimum, amplitude=spectrum.max() - minimum, maxfev=20)[:4]
+
+
+def measure(name, fit):
+    fit()  # compile
+    start = time.perf_counter()
+    parameters = np.asarray(fit())
+    elapsed = time.perf_counter() - start
+    center_error = np.abs(parameters[:, 2] - centers)
+    sigma_error = np.abs(parameters[:, 3] - true_sigma)
+    print(
+        f"{name:>16}: {n_spectra / elapsed:9.0f} fits/s, center error {center_error.mean():.4f} "
+        f"(max {center_error.max():.4f}), sigma error {sigma_error.mean():.4f} (max {sigma_error.max():.4f})"
+    )
+    return parameters
+
+
+reference = measure("gauss_fit_psss", lambda: [call(gauss_fit_psss, spectrum) for spectrum in spectra])
+single = measure("gauss_fit", lambda: [call(gauss_fit, spectrum) for spectrum in spectra])
+many = measure("gauss_fit_many", lambda: gauss_fit_many(spectra, axis)[0])
+print(f"max parameter difference to gauss_fit_psss: {np.max(np.abs(single - reference), axis=0)}")
+
+# the reported errors should match the scatter of the fitted centers around the true ones
+_, perrs = gauss_fit_many(spectra, axis)
+print(f"mean center error estimate {perrs[:, 2].mean():.4f}, rms center error {np.std(many[:, 2] - centers):.4f}")
@@ -0,0 +1,74 @@
+from threading import Lock
+
+import numpy as np
+
+from spectrum_kernels import row_profile
+
+
+def detect_band(profile, row_step, nrows, threshold=0.2, margin=10):
+    """Rows (ymin, ymax) of the band around the brightest row of a subsampled row projection.
+
+    The band is the connected region above `threshold` of the peak over the median baseline,
+    widened by `margin` rows. Returns None if the peak is not above the noise.
+    """
+    signal = profile - np.median(profile)
+    peak = int(np.argmax(signal))
+    noise = 1.4826 * np.median(np.abs(signal))
+    if signal[peak] <= 5 * noise or signal[peak] <= 0:
+        return None
+
+    below = signal < threshold * signal[peak]
+    before = np.flatnonzero(below[:peak])
+    after = np.flatnonzero(below[peak:])
+    first = before[-1] + 1 if len(before) else 0
+    last = peak + after[0] if len(after) else len(profile)
+    return max(0, int(first) * row_step - margin), min(nrows, int(last) * row_step + margin)
+
+
+class AutoROI:
+    """ROI rows that follow the illuminated band of a spectrometer camera.
+
+    Every `interval` frames, the processing thread of that frame detects the band from a projection
+    of every `row_step`-th row and `col_step`-th column. The ROI only moves when one of its edges
+    moves by more than `hysteresis` rows, so that it does not jitter with the shot-to-shot
+    intensity. `roi` is None until a band was detected.
+    """
+
+    def __init__(self, interval=10, threshold=0.2, margin=10, hysteresis=8, row_step=4, col_step=8):
+        self.interval = interval
+        self.threshold = threshold
+        self.margin = margin
+        self.hysteresis = hysteresis
+        self.row_step = row_step
+        self.col_step = col_step
+        self.roi = None
+        self._frames = 0
+        self._lock = Lock()
+
+    def due(self):
+        with self._lock:
+            self._frames += 1
+            return (self._frames - 1) % self.interval == 0
+
+    def update(self, image):
+        nrows = image.shape[0]
+        profile = row_profile(image, self.row_step, self.col_step, np.empty(-(-nrows // self.row_step)))
+        band = detect_band(profile, self.row_step, nrows, self.threshold, self.margin)
+        current = self.roi
+        if band is None:
+            return current
+        if current is None or max(abs(band[0] - current[0]), abs(band[1] - current[1])) > self.hysteresis:
+            self.roi = band
+        return self.roi
+
+
+def from_parameters(parameters):
+    # None unless "auto_roi" is enabled in the pipeline config
+    if not parameters.get("auto_roi", False):
+        return None
+    return AutoROI(
+        parameters.get("auto_roi_interval", 10),
+        parameters.get("auto_roi_threshold", 0.2),
+        parameters.get("auto_roi_margin", 10),
+        parameters.get("auto_roi_hysteresis", 8),
+    )
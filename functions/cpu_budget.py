@@ -0,0 +1,75 @@
+import json
+import os
+import threading
+from collections import namedtuple
+from logging import getLogger
+
+import numba
+
+_logger = getLogger(__name__)
+
+# per host budget, e.g. {"cores": 24, "pipelines": {"SARFE10-PSSS059_psss": {"cores": 6, "cpus": [0, 1, 2, 3, 4, 5]}}}
+BUDGET_FILE = os.environ.get("PIPELINE_CPU_BUDGET_FILE", "/etc/cam_server/cpu_budget.json")
+
+Allocation = namedtuple("Allocation", ["pipeline", "host_cores", "cores", "processing_threads", "numba_threads",
+                                       "blas_threads", "cpus"])
+
+_local = threading.local()
+
+
+def read_budget(filename=BUDGET_FILE):
+    # the budget file if there is one, the host core count from PIPELINE_CPU_BUDGET or the machine otherwise
+    budget = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            budget = json.load(f)
+    if "cores" not in budget:
+        budget["cores"] = int(os.environ.get("PIPELINE_CPU_BUDGET", os.cpu_count()))
+    return budget
+
+
+def allocate(pipeline, processing_threads=1, budget=None):
+    """CPU allocation of a pipeline from the host budget.
+
+    A pipeline listed in the budget gets its "cores", optional "cpus" affinity and "blas_threads".
+    Other pipelines share the cores the listed ones leave, with one core per processing thread at
+    most. The cores are split between the processing threads, which then use
+    cores // processing_threads numba threads each. BLAS gets as many threads as numba unless the
+    budget sets "blas_threads".
+    """
+    budget = read_budget() if budget is None else budget
+    host_cores = budget["cores"]
+    pipelines = budget.get("pipelines", {})
+    entry = pipelines.get(pipeline)
+    if entry is None:
+        entry = {}
+        cores = min(processing_threads, host_cores - sum(listed.get("cores", 0) for listed in pipelines.values()))
+        if cores < processing_threads:
+            _logger.warning("Pipeline %s is not in the CPU budget, %d cores left for it", pipeline, max(cores, 0))
+        cores = max(cores, 1)
+    else:
+        cores = min(entry.get("cores", processing_threads), host_cores)
+    numba_threads = min(max(1, cores // processing_threads), numba.config.NUMBA_NUM_THREADS)
+    cpus = tuple(entry["cpus"]) if "cpus" in entry else None
+    allocation = Allocation(pipeline, host_cores, cores, processing_threads, numba_threads,
+                            entry.get("blas_threads", numba_threads), cpus)
+
+    if processing_threads * numba_threads > cores:
+        _logger.warning("Pipeline %s runs %d threads on %d cores", pipeline, processing_threads * numba_threads, cores)
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(limits=allocation.blas_threads)
+    except ImportError:
+        _logger.warning("threadpoolctl not installed, BLAS threads of %s not limited", pipeline)
+    return allocation
+
+
+def apply(allocation):
+    # numba thread count and affinity are per thread, applied once on each processing thread
+    if getattr(_local, "allocation", None) == allocation:
+        return
+    numba.set_num_threads(allocation.numba_threads)
+    if allocation.cpus is not None:
+        os.sched_setaffinity(0, allocation.cpus)
+    _local.allocation = allocation
@@ -0,0 +1,101 @@
+from threading import Lock
+
+import numba
+import numpy as np
+
+
+@numba.njit(nogil=True, cache=True)
+def update_running_mean(estimate, image, weight):
+    # estimate += weight * (image - estimate), in place on the float32 estimate
+    w = np.float32(weight)
+    for i in range(estimate.shape[0]):
+        for j in range(estimate.shape[1]):
+            estimate[i, j] += w * (np.float32(image[i, j]) - estimate[i, j])
+
+
+@numba.njit(nogil=True, cache=True)
+def update_frugal_median(estimate, image, step):
+    # frugal streaming median, each pixel moves by step towards the new value
+    s = np.float32(step)
+    for i in range(estimate.shape[0]):
+        for j in range(estimate.shape[1]):
+            v = np.float32(image[i, j])
+            if v > estimate[i, j]:
+                estimate[i, j] += s
+            elif v < estimate[i, j]:
+                estimate[i, j] -= s
+
+
+class DarkBackground:
+    """Camera background estimated online from the dark shots, as a float32 image.
+
+    With method "mean" the estimate is the mean of the first 1 / `weight` dark frames and then a
+    running mean with that weight. With method "median" it is a frugal median approximation that
+    moves every pixel by `step` counts per dark frame, which ignores outliers such as stray shots.
+    Processing threads only read `snapshot`, a (version, image) tuple with a read-only copy of the
+    estimate, replaced as a whole every `publish_every` dark frames.
+    """
+
+    def __init__(self, method="mean", weight=0.05, step=1.0, publish_every=10):
+        if method not in ("mean", "median"):
+            raise ValueError(f"Unknown online background method {method}.")
+        self.method = method
+        self.weight = weight
+        self.step = step
+        self.publish_every = publish_every
+        self.snapshot = None
+        self.version = 0
+        self.count = 0
+        self._estimate = None
+        self._lock = Lock()
+
+    def update(self, image):
+        with self._lock:
+            if self._estimate is None or self._estimate.shape != image.shape:
+                self._estimate = np.array(image, dtype=np.float32)
+                self.count = 0
+            elif self.method == "mean":
+                update_running_mean(self._estimate, image, max(1.0 / (self.count + 1), self.weight))
+            else:
+                update_frugal_median(self._estimate, image, self.step)
+            self.count += 1
+
+            if self.count == 1 or self.count % self.publish_every == 0:
+                estimate = self._estimate.copy()
+                estimate.flags.writeable = False
+                self.version += 1
+                self.snapshot = (self.version, estimate)
+
+
+def warm_up(image_dtypes=(np.uint16,)):
+    # compiles, or loads from the on-disk cache, the update kernels for the frame types of the pipelines
+    estimate = np.zeros((8, 64), dtype=np.float32)
+    for dtype in image_dtypes:
+        image = np.ones(estimate.shape, dtype=dtype)
+        image.flags.writeable = False
+        update_running_mean(estimate, image, 0.5)
+        update_frugal_median(estimate, image, 1.0)
+
+
+def is_dark(bsdata, parameters):
+    # the dark shots are flagged by the event code "dark_event" in the "events" channel, as in the ATT pipelines
+    if not bsdata or parameters["events"] not in bsdata:
+        return False
+    events = bsdata[parameters["events"]]
+    return events is not None and bool(events[parameters["dark_event"]])
+
+
+def from_parameters(parameters):
+    # None unless "online_background" is set to "mean" or "median" in the pipeline config
+    method = parameters.get("online_background")
+    if not method:
+        return None
+    missing = [key for key in ("events", "dark_event") if parameters.get(key) is None]
+    if missing:
+        raise ValueError(f"Online background needs the dark shot keys {', '.join(missing)} in the config.")
+    return DarkBackground(
+        method,
+        parameters.get("online_background_weight", 0.05),
+        parameters.get("online_background_step", 1.0),
+        parameters.get("online_background_publish", 10),
+    )
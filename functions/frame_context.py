@@ -0,0 +1,33 @@
+import threading
+
+import numpy as np
+
+_local = threading.local()
+
+
+class FrameContext:
+    """State of one processing thread, with scratch buffers reused across its frames.
+
+    A buffer is reallocated only when the requested shape or dtype changes. Arrays that are
+    returned in the processed data outlive the frame and must not be scratch buffers.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def buffer(self, name, shape, dtype=np.float64):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+
+def get_context(owner):
+    # one context per processing thread and pipeline function, created on its first frame
+    contexts = getattr(_local, "contexts", None)
+    if contexts is None:
+        contexts = _local.contexts = {}
+    if owner not in contexts:
+        contexts[owner] = FrameContext()
+    return contexts[owner]
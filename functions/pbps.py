@@ -1,113 +1,640 @@
-import time
-from collections import defaultdict, deque
+import math
+from bisect import bisect_right
+from collections import defaultdict
 from functools import partial
 from logging import getLogger
-from threading import Thread
+from threading import Lock
 
 import epics
 import numpy as np
-from cam_server.utils import create_thread_pvs
+
+import pipeline_workers
+import pv_publisher
 
 _logger = getLogger(__name__)
 
 initialized = False
 
-dif_vals = defaultdict(int)
+publisher = None
+
+
+class RingBuffer:
+    """Fixed-size float64 ring buffer with O(1) appends and zero-copy ordered views.
+
+    Every sample is written twice, at `index` and `index + maxlen`, so the last `maxlen` samples
+    are always available as one contiguous slice of the backing array.
+    """
+
+    def __init__(self, maxlen):
+        self.maxlen = maxlen
+        self._data = np.full(2 * maxlen, np.nan)
+        self._index = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def full(self):
+        return self._count == self.maxlen
+
+    def append(self, value):
+        index = self._index
+        self._data[index] = value
+        self._data[index + self.maxlen] = value
+        self._index = (index + 1) % self.maxlen
+        if self._count < self.maxlen:
+            self._count += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64)[-self.maxlen :]
+        n_values = len(values)
+        positions = (self._index + np.arange(n_values)) % self.maxlen
+        self._data[positions] = values
+        self._data[positions + self.maxlen] = values
+        self._index = (self._index + n_values) % self.maxlen
+        self._count = min(self._count + n_values, self.maxlen)
+
+    def view(self):
+        # oldest to newest, read-only so that consumers can not corrupt the buffer
+        start = self._index + self.maxlen - self._count
+        view = self._data[start : start + self._count]
+        view.flags.writeable = False
+        return view
+
+    def valid(self):
+        view = self.view()
+        return view[np.isfinite(view)]
+
+    def nanmean(self):
+        return np.nanmean(self.view())
+
+    def nanstd(self):
+        return np.nanstd(self.view())
+
+
+class P2Quantiles:
+    """Streaming estimate of several quantiles with the extended P² algorithm (Raatikainen 1987).
+
+    Keeps 2m+3 markers for m quantiles, so memory and the cost per sample are constant. Estimates
+    are made over tumbling windows of `window` samples; `quantiles()` returns the estimates of the
+    last completed window, so that the published values follow drifts of the beam.
+    """
+
+    def __init__(self, probabilities=(0.05, 0.25, 0.5, 0.75, 0.95), window=1000):
+        self.probabilities = tuple(probabilities)
+        self.window = window
+
+        marker_probabilities = [0.0]
+        previous = 0.0
+        for probability in self.probabilities:
+            marker_probabilities += [(previous + probability) / 2, probability]
+            previous = probability
+        marker_probabilities += [(previous + 1) / 2, 1.0]
+        self._increments = marker_probabilities
+        self._n_markers = len(marker_probabilities)
+
+        self._last = np.full(len(self.probabilities), np.nan)
+        self._reset()
+
+    def _reset(self):
+        self._count = 0
+        self._heights = []
+        self._positions = list(range(1, self._n_markers + 1))
+        self._desired = [1 + (self._n_markers - 1) * increment for increment in self._increments]
+
+    def _estimates(self):
+        if self._count >= self._n_markers:
+            return np.array(self._heights[2 : -2 : 2])
+        if self._count:
+            return np.quantile(self._heights, self.probabilities)
+        return np.full(len(self.probabilities), np.nan)
+
+    def add(self, value):
+        if not math.isfinite(value):
+            return
+
+        self._count += 1
+        heights = self._heights
+        if self._count <= self._n_markers:
+            heights.append(value)
+            heights.sort()
+        else:
+            positions = self._positions
+            if value < heights[0]:
+                heights[0] = value
+                cell = 0
+            elif value >= heights[-1]:
+                heights[-1] = value
+                cell = self._n_markers - 2
+            else:
+                cell = bisect_right(heights, value) - 1
+
+            for i in range(cell + 1, self._n_markers):
+                positions[i] += 1
+            desired = self._desired
+            for i, increment in enumerate(self._increments):
+                desired[i] += increment
+
+            # move the inner markers towards their desired positions, piecewise-parabolic if possible
+            for i in range(1, self._n_markers - 1):
+                delta = desired[i] - positions[i]
+                if (delta >= 1 and positions[i + 1] - positions[i] > 1) or (
+                    delta <= -1 and positions[i - 1] - positions[i] < -1
+                ):
+                    step = 1 if delta > 0 else -1
+                    height = heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                        (positions[i] - positions[i - 1] + step)
+                        * (heights[i + 1] - heights[i])
+                        / (positions[i + 1] - positions[i])
+                        + (positions[i + 1] - positions[i] - step)
+                        * (heights[i] - heights[i - 1])
+                        / (positions[i] - positions[i - 1])
+                    )
+                    if not heights[i - 1] < height < heights[i + 1]:
+                        height = heights[i] + step * (heights[i + step] - heights[i]) / (
+                            positions[i + step] - positions[i]
+                        )
+                    heights[i] = height
+                    positions[i] += step
+
+        if self._count == self.window:
+            self._last = self._estimates()
+            self._reset()
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+
+        # complete windows inside the batch are evaluated exactly, only the ends go through the markers
+        head = min(self.window - self._count, len(values))
+        for value in values[:head]:
+            self.add(value)
+        n_windows = (len(values) - head) // self.window
+        if n_windows:
+            last_window = values[head + (n_windows - 1) * self.window : head + n_windows * self.window]
+            self._last = np.quantile(last_window, self.probabilities)
+        for value in values[head + n_windows * self.window :]:
+            self.add(value)
+
+    def quantiles(self):
+        return self._last
+
+
+class WindowedStats(RingBuffer):
+    """Ring buffer with mean, variance and histogram of its window, updated incrementally.
+
+    Appends only write the ring buffer. When a snapshot is taken, the samples written since the
+    previous one are added to and the samples that left the window are removed from Welford
+    accumulators and, if `hist_range` is given, from fixed-bin histogram counts, so a snapshot costs
+    O(new samples + bins) instead of O(maxlen). Non-finite samples are kept in the window but
+    ignored by the statistics. With `quantiles`, robust widths come from a P² sketch over tumbling
+    windows of the same length.
+    """
+
+    def __init__(self, maxlen, bins=101, hist_range=None, quantiles=False):
+        super().__init__(maxlen)
+        self.sketch = P2Quantiles(window=maxlen) if quantiles else None
+        self.bins = bins
+        self.hist_range = hist_range
+        if hist_range is not None:
+            low, high = hist_range
+            edges = np.linspace(low, high, bins + 1)
+            self._hist_centers = (edges[1:] + edges[:-1]) / 2
+            self._hist_scale = bins / (high - low)
+            self._hist = np.zeros(bins, dtype=np.int64)
+        # the writers hold _lock only to append, snapshots hold _stats_lock while they catch up
+        self._lock = Lock()
+        self._stats_lock = Lock()
+        self._written = 0
+        self._synced = 0
+        self._synced_window = np.empty(0)
+        self._since_resync = 0
+        self._reset()
+
+    def _reset(self):
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def _hist_counts(self, values):
+        low, high = self.hist_range
+        values = values[(values >= low) & (values <= high)]
+        indexes = np.minimum(((values - low) * self._hist_scale).astype(np.intp), self.bins - 1)
+        return np.bincount(indexes, minlength=self.bins)
+
+    def _add_batch(self, values):
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        n_batch = len(values)
+        mean_batch = np.mean(values)
+        n = self._n + n_batch
+        delta = mean_batch - self._mean
+        self._m2 += np.sum((values - mean_batch) ** 2) + delta**2 * self._n * n_batch / n
+        self._mean += delta * n_batch / n
+        self._n = n
+        if self.hist_range is not None:
+            self._hist += self._hist_counts(values)
+
+    def _remove_batch(self, values):
+        values = values[np.isfinite(values)]
+        if not len(values):
+            return
+        n_batch = len(values)
+        mean_batch = np.mean(values)
+        n = self._n - n_batch
+        if n <= 0:
+            self._reset()
+        else:
+            mean = (self._mean * self._n - mean_batch * n_batch) / n
+            delta = mean_batch - mean
+            m2 = self._m2 - np.sum((values - mean_batch) ** 2) - delta**2 * n * n_batch / self._n
+            self._n, self._mean, self._m2 = n, mean, max(m2, 0.0)
+        if self.hist_range is not None:
+            self._hist -= self._hist_counts(values)
+
+    def _resync(self, window):
+        # recompute from the window once per turnover to bound the rounding drift of the removals
+        valid = window[np.isfinite(window)]
+        self._n = len(valid)
+        self._mean = float(np.mean(valid)) if self._n else 0.0
+        self._m2 = float(np.sum((valid - self._mean) ** 2)) if self._n else 0.0
+        if self.hist_range is not None:
+            self._hist[:] = self._hist_counts(valid)
+        self._since_resync = 0
+
+    def _catch_up(self):
+        # called with _stats_lock held, brings the statistics up to the samples written so far
+        with self._lock:
+            written = self._written
+            window = self.view().copy()
+        n_new = written - self._synced
+        if not n_new:
+            return
+        entering = window[max(len(window) - n_new, 0) :]
+        self._since_resync += n_new
+        if self._since_resync >= self.maxlen:
+            self._resync(window)
+        else:
+            n_leaving = len(self._synced_window) + n_new - len(window)
+            self._remove_batch(self._synced_window[:n_leaving])
+            self._add_batch(entering)
+        if self.sketch is not None:
+            self.sketch.extend(entering)
+        self._synced_window = window
+        self._synced = written
+
+    def append(self, value):
+        with self._lock:
+            super().append(value)
+            self._written += 1
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        with self._lock:
+            super().extend(values)
+            self._written += len(values)
+
+    def stats(self):
+        with self._stats_lock:
+            self._catch_up()
+            if not self._n:
+                return 0, np.nan, np.nan
+            return self._n, self._mean, math.sqrt(self._m2 / self._n)
+
+    def quantiles(self):
+        # 5 %, 25 %, 50 %, 75 % and 95 % quantiles of the last completed sketch window
+        if self.sketch is None:
+            return np.full(5, np.nan)
+        with self._stats_lock:
+            self._catch_up()
+            return self.sketch.quantiles()
+
+    def histogram(self):
+        if self.hist_range is not None:
+            with self._stats_lock:
+                self._catch_up()
+                return self._hist_centers, self._hist.copy()
+
+        # no configured range, bin edges follow the data
+        with self._lock:
+            valid = self.valid()
+        y_hist, x_hist = np.histogram(valid, bins=self.bins)
+        return (x_hist[1:] + x_hist[:-1]) / 2, y_hist
+
+
+class PulsePattern:
+    """Routes pulses to the classes of a bunch pattern, either by pulse ID modulo or by event code.
+
+    The default pattern splits pulses into the classic "evn" and "odd" classes. Modulo patterns list
+    one class name per remainder (repeated names merge remainders), event code patterns map class
+    names to event codes of an event set channel, e.g. SAR-CVME-TIFALL5:EvtSet.
+    """
+
+    def __init__(self, config=None):
+        config = config or {"modulo": 2, "classes": ["evn", "odd"]}
+        self.events = config.get("events")
+
+        if self.events:
+            self.classes = list(config["event_codes"])
+            self._codes = np.array(list(config["event_codes"].values()))
+        else:
+            self.modulo = config["modulo"]
+            if len(config["classes"]) != self.modulo:
+                raise ValueError(f"Pulse pattern needs one class per remainder of modulo {self.modulo}.")
+            self.classes = list(dict.fromkeys(config["classes"]))
+            self._class_of = np.array([self.classes.index(name) for name in config["classes"]])
+
+        self.labels = [(f"xpos_{name}", f"ypos_{name}") for name in self.classes]
+        if not self.events:
+            self._labels_of = [(self.labels[index],) for index in self._class_of]
+
+    def route(self, pulse_id, data):
+        # buffer labels of the classes the pulse belongs to
+        if not self.events:
+            return self._labels_of[pulse_id % self.modulo]
+        # a pulse without the event channel belongs to no class
+        events = data.get(self.events)
+        if events is None:
+            return []
+        return [self.labels[index] for index in np.flatnonzero(np.asarray(events)[self._codes])]
+
+    def masks(self, pulse_ids, data):
+        # one boolean mask over the pulses per class
+        if not self.events:
+            class_index = self._class_of[pulse_ids % self.modulo]
+            return [class_index == index for index in range(len(self.classes))]
+        # pulses without the event channel belong to no class, as in route
+        events = data.get(self.events)
+        if events is None:
+            return [np.zeros(len(pulse_ids), dtype=bool) for _ in self.classes]
+        return list(np.asarray(events)[:, self._codes].astype(bool).T)
+
+
+class RLSCalibrator:
+    """Recursive least squares fit of `target = inputs @ coefficients` with exponential forgetting.
+
+    The covariance is initialised on the first update relative to the input scale and its trace is
+    capped there afterwards, so that it does not wind up while the inputs are not excited.
+    """
+
+    def __init__(self, coefficients, forgetting=0.999, delta=1.0):
+        self.coefficients = np.array(coefficients, dtype=np.float64)
+        self.forgetting = forgetting
+        self.delta = delta
+        self.residual = np.nan
+        self.updates = 0
+        self._covariance = None
+        self._max_trace = None
+
+    def update(self, inputs, target):
+        inputs = np.asarray(inputs, dtype=np.float64)
+        if not (np.all(np.isfinite(inputs)) and math.isfinite(target)):
+            return
+
+        if self._covariance is None:
+            scale = inputs @ inputs / len(inputs)
+            if not scale:
+                return
+            self._covariance = np.eye(len(inputs)) * self.delta / scale
+            self._max_trace = np.trace(self._covariance)
+
+        covariance = self._covariance
+        p_inputs = covariance @ inputs
+        gain = p_inputs / (self.forgetting + inputs @ p_inputs)
+
+        # a priori residual, i.e. the error of the prediction with the previous coefficients
+        self.residual = target - inputs @ self.coefficients
+        self.coefficients += gain * self.residual
+
+        covariance = (covariance - np.outer(gain, p_inputs)) / self.forgetting
+        trace = np.trace(covariance)
+        if trace > self._max_trace:
+            covariance *= self._max_trace / trace
+        self._covariance = covariance
+        self.updates += 1
+
+
+class OnlineCalibration:
+    """Tracks uJ_calib and relative diode gains of one device against the gas monitor energy.
+
+    Both fits use the diode signals calibrated with the configured factors, so applying the fitted
+    uJ_calib to the outputs does not feed back into the fits.
+    """
+
+    def __init__(self, gas_monitor, uJ_calib, forgetting=0.999, apply=False):
+        self.gas_monitor = gas_monitor
+        self.uJ_calib = uJ_calib
+        self.apply = apply
+        self.uJ_fit = RLSCalibrator([uJ_calib], forgetting)
+        self.diodes_fit = RLSCalibrator(np.ones(4), forgetting)
+
+    def update(self, energy, up, down, right, left, intensity):
+        if energy is None or not intensity > 0:
+            return
+        self.uJ_fit.update([intensity], energy)
+        self.diodes_fit.update(self.uJ_calib * np.array([up, down, right, left]), energy)
+
+    def outputs(self, device):
+        return {
+            f"{device}:UJ_CALIB": self.uJ_fit.coefficients[0],
+            f"{device}:UJ_CALIB_RESIDUAL": self.uJ_fit.residual,
+            f"{device}:DIODE_GAINS": self.diodes_fit.coefficients.copy(),
+            f"{device}:DIODE_GAINS_RESIDUAL": self.diodes_fit.residual,
+        }
+
+
+def get_pulse_differences(block, pattern):
+    # pairs of classes to publish the differences of, by default the classic odd - even
+    if "pulse_differences" in block:
+        return [tuple(pair) for pair in block["pulse_differences"]]
+    if "odd" in pattern.classes and "evn" in pattern.classes:
+        return [("odd", "evn")]
+    return []
+
+
+# per device state, keyed by the device name that prefixes the bs outputs
+device_names = []
+patterns = {}
+calibrations = {}
 
 # this is to avoid exceptions in the 'process' function upon appending to buffers if not all of
 # them were created in the 'initialize' function
-buffers = defaultdict(partial(deque, maxlen=1))
+buffers = defaultdict(partial(defaultdict, partial(RingBuffer, 1)))
 
+dif_vals = defaultdict(partial(defaultdict, int))
 
-def initialize(params):
-    global initialized
+# outgoing PV names, published by the process wide pv_publisher
+hist_outputs = defaultdict(dict)
+quantile_outputs = defaultdict(dict)
+dif_outputs = defaultdict(dict)
 
-    epics.ca.clear_cache()
+# stream inputs and calibration of all devices, stacked for the vectorized computation
+input_channels = []
+calib = {}
 
-    for label in ("xpos_all", "ypos_all", "xpos_odd", "ypos_odd", "xpos_evn", "ypos_evn"):
-        x_pvname = params[f"{label}_x_pvname"]
-        y_pvname = params[f"{label}_y_pvname"]
-        m_pvname = params[f"{label}_m_pvname"]
-        w_pvname = params[f"{label}_w_pvname"]
+# workers of the PV publisher this pipeline runs on, sampled once per publisher cycle
+live_workers = 0
 
-        if x_pvname and y_pvname and m_pvname and w_pvname:
-            buffer = deque(maxlen=params["queue_length"])
-            buffers[label] = buffer
 
-            thread = Thread(target=update_PVs, args=(label, buffer, x_pvname, y_pvname, m_pvname, w_pvname))
-            thread.start()
+def get_device_blocks(params):
+    # a config either describes a single device at the top level, or lists several devices under
+    # "devices", where each block overrides the shared top level settings
+    if "devices" not in params:
+        return [params]
 
-    # diff PVs
-    xpos_dif_m_pvname = params["xpos_dif_m_pvname"]
-    xpos_dif_w_pvname = params["xpos_dif_w_pvname"]
-    ypos_dif_m_pvname = params["ypos_dif_m_pvname"]
-    ypos_dif_w_pvname = params["ypos_dif_w_pvname"]
+    shared = {key: value for key, value in params.items() if key != "devices"}
+    return [{**shared, **block} for block in params["devices"]]
 
-    thread = Thread(target=update_dif_PVs, args=(xpos_dif_m_pvname, xpos_dif_w_pvname, ypos_dif_m_pvname, ypos_dif_w_pvname))
-    thread.start()
 
-    initialized = True
+def get_device_name(block):
+    return block.get("device", block["up"].split(":", 1)[0])
 
 
-def update_PVs(label, buffer, x_pvname, y_pvname, m_pvname, w_pvname):
-    x_pv, y_pv, m_pv, w_pv = create_thread_pvs([x_pvname, y_pvname, m_pvname, w_pvname])
+def compute(up, down, right, left, uJ_calib, threshold, horiz_calib, vert_calib):
+    # element-wise, so that it serves both many devices of one pulse and many pulses of one device
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intensity = down + up + left + right
+        intensity_uJ = intensity * uJ_calib
+
+        above = intensity > threshold
+        xpos = np.where(above, ((right - left) / (right + left)) * horiz_calib, np.nan)
+        ypos = np.where(above, ((up - down) / (up + down)) * vert_calib, np.nan)
+
+    return intensity, intensity_uJ, xpos, ypos
+
+
+def setup_devices(params):
+    blocks = get_device_blocks(params)
+    names = [get_device_name(block) for block in blocks]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate device names {', '.join(duplicates)}, set a unique \"device\" in each block.")
+    device_names[:] = names
+
+    patterns.clear()
+    calibrations.clear()
+    buffers.clear()
+    hist_outputs.clear()
+    quantile_outputs.clear()
+    dif_outputs.clear()
+    dif_vals.clear()
+    for device, block in zip(device_names, blocks):
+        pattern = PulsePattern(block.get("pulse_pattern"))
+        patterns[device] = pattern
+
+        # optional online calibration against the gas monitor, e.g.
+        # "gas_monitor": "SARFE10-PBPG050:PHOTON-ENERGY-PER-PULSE-AVG"
+        if block.get("gas_monitor"):
+            # the gas monitor value is read from the stream, a channel that is not requested is
+            # missing from every pulse and the calibration never updates
+            if block["gas_monitor"] not in params.get("bsread_channels", []):
+                _logger.warning("Gas monitor %s of %s is not in bsread_channels, the online calibration "
+                                "will not update", block["gas_monitor"], device)
+            calibrations[device] = OnlineCalibration(
+                block["gas_monitor"],
+                block["uJ_calib"],
+                forgetting=block.get("online_calib_forgetting", 0.999),
+                apply=block.get("online_calib_apply", False),
+            )
+
+        labels = [label for axis_labels in [("xpos_all", "ypos_all")] + pattern.labels for label in axis_labels]
+        for label in labels:
+            # optional robust stats PVs, e.g. "xpos_all_med_pvname"
+            pvnames = {stat: block.get(f"{label}_{stat}_pvname") for stat in ("med", "iqr", "p05", "p95")}
+            pvnames = {stat: pvname for stat, pvname in pvnames.items() if pvname}
+            if pvnames:
+                quantile_outputs[device][label] = pvnames
+
+            # the P² sketch only runs for labels with robust stats PVs
+            axis = label.split("_")[0]
+            buffers[device][label] = WindowedStats(
+                block["queue_length"],
+                bins=block.get("hist_bins", 101),
+                hist_range=block.get(f"{axis}_hist_range"),
+                quantiles=bool(pvnames),
+            )
+
+            x_pvname = block.get(f"{label}_x_pvname")
+            y_pvname = block.get(f"{label}_y_pvname")
+            m_pvname = block.get(f"{label}_m_pvname")
+            w_pvname = block.get(f"{label}_w_pvname")
+
+            if x_pvname and y_pvname and m_pvname and w_pvname:
+                hist_outputs[device][label] = (x_pvname, y_pvname, m_pvname, w_pvname)
+
+        # diff PVs, the classic odd - even difference keeps its original config keys
+        for first, second in get_pulse_differences(block, pattern):
+            dif = "dif" if (first, second) == ("odd", "evn") else f"{first}_{second}_dif"
+            for axis in ("xpos", "ypos"):
+                for stat in ("m", "w"):
+                    dif_outputs[device][(axis, first, second, stat)] = block.get(f"{axis}_{dif}_{stat}_pvname")
+
+    # inputs are ordered by diode first, so that they reshape to (4, number of devices)
+    diodes = ("up", "down", "right", "left")
+    input_channels[:] = [block[diode] for diode in diodes for block in blocks]
+    calib["diodes"] = np.array([[block[f"{diode}_calib"] for block in blocks] for diode in diodes])
+    for key in ("uJ_calib", "threshold", "horiz_calib", "vert_calib"):
+        calib[key] = np.array([block[key] for block in blocks], dtype=np.float64)
 
-    x_pv.wait_for_connection()
-    y_pv.wait_for_connection()
-    m_pv.wait_for_connection()
-    w_pv.wait_for_connection()
-    if not (x_pv.connected and y_pv.connected and m_pv.connected and w_pv.connected):
-        raise (f"Cannot connect to {label} PVs.")
 
-    x_pv.put(np.arange(buffer.maxlen))
-    y_pv.put(np.zeros(buffer.maxlen))
-    m_pv.put(0)
-    w_pv.put(0)
+def initialize(params):
+    global initialized, publisher, live_workers
 
-    while True:
-        time.sleep(3)
-        if len(buffer) != buffer.maxlen:
-            continue
+    epics.ca.clear_cache()
 
-        _buffer = np.array(buffer)
-        _buffer = _buffer[~np.isnan(_buffer)]
+    setup_devices(params)
 
-        # histogram
-        y_hist, x_hist = np.histogram(_buffer, bins=101)
-        x_hist = (x_hist[1:] + x_hist[:-1]) / 2
+    publisher = pv_publisher.get_publisher(params.get("publish_interval", 3))
+    for device in device_names:
+        for label, (x_pvname, y_pvname, m_pvname, w_pvname) in hist_outputs[device].items():
+            publisher.put(x_pvname, np.arange(buffers[device][label].maxlen))
+            publisher.put(y_pvname, np.zeros(buffers[device][label].maxlen))
+            publisher.put(m_pvname, 0)
+            publisher.put(w_pvname, 0)
+    publisher.register(__name__, collect_PV_values)
+    live_workers = pipeline_workers.live_workers(pv_publisher.__name__)
 
-        x_pv.put(x_hist)
-        y_pv.put(y_hist)
+    initialized = True
 
-        # stats
-        mean_val = np.mean(_buffer)
-        std_val = np.std(_buffer)
 
-        m_pv.put(mean_val)
-        w_pv.put(std_val)
+def collect_PV_values():
+    global live_workers
 
-        dif_vals[f"{label}_m"] = mean_val
-        dif_vals[f"{label}_w"] = std_val
+    values = {}
+    live_workers = pipeline_workers.live_workers(pv_publisher.__name__)
 
+    for device in device_names:
+        for label, buffer in buffers[device].items():
+            if not buffer.full:
+                continue
 
-def update_dif_PVs(xpos_dif_m_pvname, xpos_dif_w_pvname, ypos_dif_m_pvname, ypos_dif_w_pvname):
-    xpos_dif_m_pv, xpos_dif_w_pv, ypos_dif_m_pv, ypos_dif_w_pv = create_thread_pvs(
-        [xpos_dif_m_pvname, xpos_dif_w_pvname, ypos_dif_m_pvname, ypos_dif_w_pvname]
-    )
+            # stats
+            _, mean_val, std_val = buffer.stats()
+            dif_vals[device][f"{label}_m"] = mean_val
+            dif_vals[device][f"{label}_w"] = std_val
+
+            if label in hist_outputs[device]:
+                x_pvname, y_pvname, m_pvname, w_pvname = hist_outputs[device][label]
+
+                # histogram
+                values[x_pvname], values[y_pvname] = buffer.histogram()
 
-    xpos_dif_m_pv.wait_for_connection()
-    xpos_dif_w_pv.wait_for_connection()
-    ypos_dif_m_pv.wait_for_connection()
-    ypos_dif_w_pv.wait_for_connection()
-    if not (xpos_dif_m_pv.connected and xpos_dif_w_pv.connected and ypos_dif_m_pv.connected and ypos_dif_w_pv.connected):
-        raise (f"Cannot connect to dif PVs.")
+                values[m_pvname] = mean_val
+                values[w_pvname] = std_val
 
-    while True:
-        time.sleep(3)
-        xpos_dif_m_pv.put(dif_vals["xpos_odd_m"] - dif_vals["xpos_evn_m"])
-        xpos_dif_w_pv.put(dif_vals["xpos_odd_w"] - dif_vals["xpos_evn_w"])
-        ypos_dif_m_pv.put(dif_vals["ypos_odd_m"] - dif_vals["ypos_evn_m"])
-        ypos_dif_w_pv.put(dif_vals["ypos_odd_w"] - dif_vals["ypos_evn_w"])
+            if label in quantile_outputs[device]:
+                p05, p25, p50, p75, p95 = buffer.quantiles()
+                robust_vals = {"med": p50, "iqr": p75 - p25, "p05": p05, "p95": p95}
+                for stat, pvname in quantile_outputs[device][label].items():
+                    values[pvname] = robust_vals[stat]
+
+        for (axis, first, second, stat), pvname in dif_outputs[device].items():
+            if pvname:
+                values[pvname] = dif_vals[device][f"{axis}_{first}_{stat}"] - dif_vals[device][f"{axis}_{second}_{stat}"]
+
+    return values
 
 
 def process(data, pulse_id, timestamp, params):
@@ -115,43 +642,82 @@ def process(data, pulse_id, timestamp, params):
     if not initialized:
         initialize(params)
 
-    # Read stream inputs
-    up = data[params["up"]] * params["up_calib"]
-    down = data[params["down"]] * params["down_calib"]
-    right = data[params["right"]] * params["right_calib"]
-    left = data[params["left"]] * params["left_calib"]
+    # Read stream inputs, missing values become NaN
+    raw = np.array([data[channel] for channel in input_channels], dtype=np.float64).reshape(4, -1)
+    up, down, right, left = raw * calib["diodes"]
 
     # Calculations
-    try:
-        intensity = down + up + left + right
-        intensity_uJ = intensity * params["uJ_calib"]
-    except:
-        intensity = np.nan
-        intensity_uJ = np.nan
-
-    if intensity > params["threshold"]:
-        xpos = ((right - left) / (right + left)) * params["horiz_calib"]
-        ypos = ((up - down) / (up + down)) * params["vert_calib"]
-    else:
-        xpos = np.nan
-        ypos = np.nan
-
-    # Update buffers
-    buffers["xpos_all"].append(xpos)
-    buffers["ypos_all"].append(ypos)
-    if pulse_id % 2:
-        buffers["xpos_odd"].append(xpos)
-        buffers["ypos_odd"].append(ypos)
-    else:
-        buffers["xpos_evn"].append(xpos)
-        buffers["ypos_evn"].append(ypos)
-
-    # Set bs outputs
+    intensity, intensity_uJ, xpos, ypos = compute(
+        up, down, right, left, calib["uJ_calib"], calib["threshold"], calib["horiz_calib"], calib["vert_calib"]
+    )
+
+    output = {}
+    latency = publisher.latency
+    for i, device in enumerate(device_names):
+        # Update buffers
+        device_buffers = buffers[device]
+        device_buffers["xpos_all"].append(xpos[i])
+        device_buffers["ypos_all"].append(ypos[i])
+        for x_label, y_label in patterns[device].route(pulse_id, data):
+            device_buffers[x_label].append(xpos[i])
+            device_buffers[y_label].append(ypos[i])
+
+        # Set bs outputs
+        output[f"{device}:INTENSITY"] = intensity[i]
+        output[f"{device}:INTENSITY_UJ"] = intensity_uJ[i]
+        output[f"{device}:XPOS"] = xpos[i]
+        output[f"{device}:YPOS"] = ypos[i]
+        output[f"{device}:PV_PUT_LATENCY"] = latency
+        output[f"{device}:LIVE_WORKERS"] = live_workers
+
+        # bsread aligns the channels by pulse ID, so the gas monitor value belongs to this pulse
+        calibration = calibrations.get(device)
+        if calibration is not None:
+            calibration.update(data.get(calibration.gas_monitor), up[i], down[i], right[i], left[i], intensity[i])
+            if calibration.apply:
+                # takes effect from the next pulse on
+                calib["uJ_calib"][i] = calibration.uJ_fit.coefficients[0]
+            output.update(calibration.outputs(device))
+
+    return output
+
+
+def process_batch(data, pulse_ids, params, update_buffers=False):
+    # Vectorized version of 'process' for arrays of pulses, e.g. for offline reprocessing. It uses
+    # the same element-wise computation as 'process', so the results are identical.
+    pulse_ids = np.asarray(pulse_ids)
+    # the buffers and pulse patterns of the devices are created by setup_devices
+    if update_buffers and not device_names:
+        setup_devices(params)
+
     output = {}
-    device, _ = params["up"].split(":", 1)
-    output[f"{device}:INTENSITY"] = intensity
-    output[f"{device}:INTENSITY_UJ"] = intensity_uJ
-    output[f"{device}:XPOS"] = xpos
-    output[f"{device}:YPOS"] = ypos
+    for block in get_device_blocks(params):
+        device = get_device_name(block)
+
+        # Read stream inputs
+        up = np.asarray(data[block["up"]], dtype=np.float64) * block["up_calib"]
+        down = np.asarray(data[block["down"]], dtype=np.float64) * block["down_calib"]
+        right = np.asarray(data[block["right"]], dtype=np.float64) * block["right_calib"]
+        left = np.asarray(data[block["left"]], dtype=np.float64) * block["left_calib"]
+
+        # Calculations
+        intensity, intensity_uJ, xpos, ypos = compute(
+            up, down, right, left, block["uJ_calib"], block["threshold"], block["horiz_calib"], block["vert_calib"]
+        )
+
+        # Update buffers
+        if update_buffers:
+            device_buffers = buffers[device]
+            device_buffers["xpos_all"].extend(xpos)
+            device_buffers["ypos_all"].extend(ypos)
+            pattern = patterns[device]
+            for (x_label, y_label), mask in zip(pattern.labels, pattern.masks(pulse_ids, data)):
+                device_buffers[x_label].extend(xpos[mask])
+                device_buffers[y_label].extend(ypos[mask])
+
+        output[f"{device}:INTENSITY"] = intensity
+        output[f"{device}:INTENSITY_UJ"] = intensity_uJ
+        output[f"{device}:XPOS"] = xpos
+        output[f"{device}:YPOS"] = ypos
 
     return output
@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import stat
+import tempfile
+
+import numpy as np
+
+DIODES = ("up", "down", "right", "left")
+
+
+def load_recording(filename, channels):
+    # columnar float64 arrays per channel, joined on the pulse IDs present in all channels
+    columns = {}
+    pulse_ids = {}
+
+    if filename.endswith(".npz"):
+        with np.load(filename) as f:
+            for channel in channels:
+                columns[channel] = np.asarray(f[channel], dtype=np.float64)
+                pulse_ids[channel] = np.asarray(f["pulse_id"])
+    else:
+        import h5py
+
+        with h5py.File(filename, "r") as f:
+            for channel in channels:
+                group = f[channel] if channel in f else f["data"][channel]
+                data = group["data"][:].astype(np.float64).reshape(-1)
+                ids = group["pulse_id"][:].reshape(-1)
+                if "is_data_present" in group:
+                    present = group["is_data_present"][:].reshape(-1).astype(bool)
+                    data, ids = data[present], ids[present]
+                columns[channel] = data
+                pulse_ids[channel] = ids
+
+    common = None
+    for ids in pulse_ids.values():
+        common = ids if common is None else np.intersect1d(common, ids)
+
+    joined = {}
+    for channel in channels:
+        _, index, _ = np.intersect1d(pulse_ids[channel], common, return_indices=True)
+        joined[channel] = columns[channel][index]
+    return common, joined
+
+
+def robust_lstsq(matrix, target, n_sigma=5.0, max_iterations=10):
+    # least squares with iterative rejection of outliers beyond n_sigma robust (MAD) deviations
+    good = np.all(np.isfinite(matrix), axis=1) & np.isfinite(target)
+    for _ in range(max_iterations):
+        solution = np.linalg.lstsq(matrix[good], target[good], rcond=None)[0]
+        residuals = target - matrix @ solution
+        sigma = 1.4826 * np.median(np.abs(residuals[good] - np.median(residuals[good])))
+        inliers = np.isfinite(residuals) & (np.abs(residuals) <= n_sigma * sigma)
+        if sigma == 0 or np.array_equal(inliers, good):
+            break
+        good = inliers
+    return solution, residuals[good].std(), np.count_nonzero(~good)
+
+
+def find_block(config, device):
+    # the block to write the results to, and the device settings including the shared top level
+    # keys, merged as pbps.get_device_blocks does
+    if "devices" not in config:
+        return config, config
+    if not device:
+        raise ValueError("Config lists several devices, select one with --device.")
+    shared = {key: value for key, value in config.items() if key != "devices"}
+    for block in config["devices"]:
+        settings = {**shared, **block}
+        if device == block.get("device") or device == settings["up"].split(":", 1)[0]:
+            return block, settings
+    raise ValueError(f"Device {device} not found in config.")
+
+
+def calibrate(columns, block, gas=None, motor_x=None, motor_y=None):
+    result = {}
+    raw = np.column_stack([columns[block[diode]] for diode in DIODES])
+
+    # diode gains from the gas monitor energy, keeping the configured uJ_calib
+    if gas:
+        gains, rms, rejected = robust_lstsq(raw, columns[gas])
+        for diode, gain in zip(DIODES, gains):
+            result[f"{diode}_calib"] = gain / block["uJ_calib"]
+        print(f"diode gains: {gains / block['uJ_calib']} (residual rms {rms:.4g} uJ, {rejected} shots rejected)")
+    else:
+        for diode in DIODES:
+            result[f"{diode}_calib"] = block[f"{diode}_calib"]
+
+    up, down, right, left = (raw * [result[f"{diode}_calib"] for diode in DIODES]).T
+
+    # position scales from the motor positions of the scan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = {"horiz_calib": (right - left) / (right + left), "vert_calib": (up - down) / (up + down)}
+    for key, motor in (("horiz_calib", motor_x), ("vert_calib", motor_y)):
+        if motor:
+            matrix = np.column_stack([ratios[key], np.ones(len(ratios[key]))])
+            (scale, offset), rms, rejected = robust_lstsq(matrix, columns[motor])
+            result[key] = scale
+            print(f"{key}: {scale:.6g}, offset {offset:.4g} (residual rms {rms:.4g}, {rejected} shots rejected)")
+
+    return result
+
+
+def write_config(filename, config):
+    # write to a temporary file next to the config and rename it, so the config is never half written.
+    # the temporary file is created with mode 0600, the config keeps its own permissions
+    directory = os.path.dirname(os.path.abspath(filename))
+    with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".json", delete=False) as f:
+        json.dump(config, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+        temp_filename = f.name
+    os.chmod(temp_filename, stat.S_IMODE(os.stat(filename).st_mode))
+    os.replace(temp_filename, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit PBPS diode gains and position scales to a recorded scan.")
+    parser.add_argument("recording", help="recorded data, sf-daq HDF5 file or npz with a 'pulse_id' array")
+    parser.add_argument("config", help="pipeline config to update, e.g. SARFE10-PBPS053_proc.json")
+    parser.add_argument("--device", help="device to calibrate in a multi-device config")
+    parser.add_argument("--gas", help="gas monitor channel, e.g. SARFE10-PBPG050:PHOTON-ENERGY-PER-PULSE-AVG")
+    parser.add_argument("--motor-x", help="channel of the horizontal scan motor position")
+    parser.add_argument("--motor-y", help="channel of the vertical scan motor position")
+    parser.add_argument("--dry-run", action="store_true", help="only print the fitted values")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = json.load(f)
+    block, settings = find_block(config, args.device)
+
+    channels = [settings[diode] for diode in DIODES] + [c for c in (args.gas, args.motor_x, args.motor_y) if c]
+    pulse_ids, columns = load_recording(args.recording, channels)
+    print(f"{len(pulse_ids)} shots")
+
+    result = calibrate(columns, settings, args.gas, args.motor_x, args.motor_y)
+    if not args.dry_run:
+        block.update(result)
+        write_config(args.config, config)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import atexit
+from collections import defaultdict
+from logging import getLogger
+from threading import Event, Lock, Thread
+
+_logger = getLogger(__name__)
+
+_workers = defaultdict(list)
+_workers_lock = Lock()
+
+
+class Worker:
+    """Daemon thread running `target(stop_event, *args)` until it is asked to stop.
+
+    Targets are expected to loop on `stop_event.wait(interval)` instead of `time.sleep(interval)`,
+    so that stopping a worker takes effect immediately.
+    """
+
+    def __init__(self, owner, target, args):
+        self.owner = owner
+        self.name = f"{owner}:{target.__name__}"
+        self.stop_event = Event()
+        self._thread = Thread(target=self._run, args=(target, args), name=self.name, daemon=True)
+
+    def _run(self, target, args):
+        try:
+            target(self.stop_event, *args)
+        except Exception:
+            _logger.exception("Worker %s failed", self.name)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self, timeout=None):
+        self._thread.join(timeout)
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+
+def start_worker(owner, target, *args):
+    worker = Worker(owner, target, args)
+    with _workers_lock:
+        _workers[owner].append(worker)
+    worker.start()
+    return worker
+
+
+def stop_workers(owner=None, timeout=5.0):
+    # stop the workers of one owner, e.g. on a function reload, or of everybody on shutdown
+    with _workers_lock:
+        owners = list(_workers) if owner is None else [owner]
+        workers = [worker for _owner in owners for worker in _workers[_owner]]
+
+    for worker in workers:
+        worker.stop()
+    for worker in workers:
+        worker.join(timeout)
+        if worker.is_alive():
+            _logger.warning("Worker %s did not stop within %.1f s", worker.name, timeout)
+
+    # workers that did not stop yet stay registered, so that they keep showing up in live_workers
+    with _workers_lock:
+        for _owner in owners:
+            _workers[_owner] = [worker for worker in _workers[_owner] if worker.is_alive()]
+
+
+def live_workers(owner=None):
+    with _workers_lock:
+        owners = list(_workers) if owner is None else [owner]
+        return sum(worker.is_alive() for _owner in owners for worker in _workers.get(_owner, []))
+
+
+atexit.register(stop_workers)
@@ -0,0 +1,120 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numba
+import numpy as np
+import scipy.signal
+
+from spectral_fit import gauss_fit_many, moment_estimate
+from spectrum_kernels import project_roi
+
+OUTPUTS = ("spectrum", "center", "fwhm", "center_err", "fwhm_err", "com", "std")
+
+
+def _project_chunk(executor, chunk, ymin, ymax, pixel_bkg, out):
+    # one nogil projection per frame, spread over the executor threads
+    futures = [executor.submit(project_roi, image, ymin, ymax, pixel_bkg, row) for image, row in zip(chunk, out)]
+    for future in futures:
+        future.result()
+
+
+def analyse_spectra(spectra, axis, nrows):
+    """Smoothing, gaussian fits and moments of (N, W) spectra, as psss.py computes them per frame."""
+    smoothed = scipy.signal.savgol_filter(spectra, 51, 3, axis=1)
+    minimum, maximum = smoothed.min(axis=1), smoothed.max(axis=1)
+    amplitude = maximum - minimum
+    fitted = amplitude > nrows * 1.5
+
+    parameters = np.empty((len(spectra), 4))
+    perrs = np.full((len(spectra), 4), np.nan)
+    if np.any(fitted):
+        parameters[fitted], perrs[fitted] = gauss_fit_many(smoothed[fitted, ::2], axis[::2])
+    for i in np.flatnonzero(~fitted):
+        parameters[i] = moment_estimate(smoothed[i, ::2], axis[::2], minimum[i], amplitude[i])
+
+    normed = smoothed / smoothed.sum(axis=1, keepdims=True)
+    com = normed @ axis
+    std = np.sqrt(np.sum((axis - com[:, None]) ** 2 * normed, axis=1))
+
+    return {
+        "center": parameters[:, 2],
+        "fwhm": 2.355 * parameters[:, 3],
+        "center_err": perrs[:, 2],
+        "fwhm_err": 2.355 * perrs[:, 3],
+        "com": com,
+        "std": std,
+    }
+
+
+def process_stack(images, axis, roi, background=None, pixel_bkg=0, chunk_size=64, workers=4):
+    """Spectra and their fitted parameters for an (N, H, W) stack of PSSS camera frames.
+
+    `images` can be any array-like that supports slicing along the first axis, such as an h5py
+    dataset, and is read `chunk_size` frames at a time. `workers` threads project the frames and
+    fit the spectra. Returns a dict of arrays with the keys in `OUTPUTS`.
+    """
+    n_images, nrows, ncols = images.shape
+    axis = np.asarray(axis, dtype=np.float64)[:ncols]
+    if len(axis) < ncols:
+        raise ValueError(f"Energy axis length {len(axis)} < image width {ncols}")
+
+    ymin, ymax = int(roi[0]), int(roi[1])
+    if not nrows >= ymax > ymin >= 0:
+        ymin, ymax = 0, nrows
+
+    spectra = np.empty((n_images, ncols), dtype=np.float64)
+    with ThreadPoolExecutor(workers) as executor:
+        for start in range(0, n_images, chunk_size):
+            stop = min(start + chunk_size, n_images)
+            chunk = np.asarray(images[start:stop])
+            _project_chunk(executor, chunk, ymin, ymax, pixel_bkg, spectra[start:stop])
+
+    if background is not None:
+        spectra -= project_roi(np.asarray(background), ymin, ymax, 0.0, np.empty(ncols, dtype=np.float64))
+
+    previous_threads = numba.get_num_threads()
+    numba.set_num_threads(min(workers, numba.config.NUMBA_NUM_THREADS))
+    try:
+        results = analyse_spectra(spectra, axis, nrows)
+    finally:
+        numba.set_num_threads(previous_threads)
+
+    results["spectrum"] = spectra
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess recorded PSSS camera frames.")
+    parser.add_argument("recording", help="HDF5 file with the camera frames")
+    parser.add_argument("output", help="npz file for the results")
+    parser.add_argument("--images", default="data/SARFE10-PSSS059/data", help="dataset of the (N, H, W) frames")
+    parser.add_argument("--axis", required=True, help="energy axis, npy file or dataset in the recording")
+    parser.add_argument("--roi", nargs=2, type=int, default=(0, 0), metavar=("YMIN", "YMAX"))
+    parser.add_argument("--background", help="npy file with the background image")
+    parser.add_argument("--pixel-bkg", type=float, default=0.0)
+    parser.add_argument("--chunk-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    import h5py
+
+    with h5py.File(args.recording, "r") as f:
+        if args.axis.endswith(".npy"):
+            axis = np.load(args.axis)
+        else:
+            # a recorded SPECTRUM_X channel has one axis per pulse
+            axis = f[args.axis][0] if f[args.axis].ndim > 1 else f[args.axis][:]
+        background = np.load(args.background) if args.background else None
+        results = process_stack(
+            f[args.images], axis, args.roi, background, args.pixel_bkg, args.chunk_size, args.workers
+        )
+        pulse_id_dataset = args.images.rsplit("/", 1)[0] + "/pulse_id"
+        if pulse_id_dataset in f:
+            results["pulse_id"] = f[pulse_id_dataset][:]
+
+    np.savez(args.output, axis=axis, **results)
+    print(f"{len(results['spectrum'])} frames processed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import time
+from logging import getLogger
+from threading import Lock
+
+import numpy as np
+from cam_server.utils import create_thread_pvs
+
+import pipeline_workers
+
+_logger = getLogger(__name__)
+
+_publisher = None
+_publisher_lock = Lock()
+
+
+def _unchanged(old, new):
+    try:
+        return np.array_equal(old, new, equal_nan=True)
+    except TypeError:
+        return np.array_equal(old, new)
+
+
+class PVPublisher:
+    """Owns the outgoing PVs of a process and puts them in batches on a fixed cadence.
+
+    Producers either register a callback returning {pvname: value}, which is called once per cycle,
+    or hand over values with `put`/`put_many`, which never block on Channel Access. Only the newest
+    pending value per PV is kept: with a pulse ID, values older than the pending or the last put one
+    are dropped. Values equal to the last one put on a PV are skipped. `max_rate` caps the puts per
+    second, values over the cap stay pending for the next cycle.
+    """
+
+    def __init__(self, interval=1.0, max_rate=None):
+        self.interval = interval
+        self.max_rate = max_rate
+        self._lock = Lock()
+        # pvname -> (pulse_id, value)
+        self._pending = {}
+        self._collectors = {}
+        self._pvs = {}
+        self._last = {}
+        self._last_pulse_ids = {}
+        self._worker = None
+
+        self.puts = 0
+        self.skipped = 0
+        self.disconnected = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.deferred = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    def register(self, owner, collect):
+        # re-registering the same owner replaces its callback, e.g. after a function reload
+        with self._lock:
+            self._collectors[owner] = collect
+
+    def unregister(self, owner):
+        with self._lock:
+            self._collectors.pop(owner, None)
+
+    def put(self, pvname, value, pulse_id=None):
+        with self._lock:
+            self._enqueue(pvname, value, pulse_id)
+
+    def put_many(self, values, pulse_id=None):
+        # {pvname: value} of one pulse, e.g. all outputs of a frame
+        with self._lock:
+            for pvname, value in values.items():
+                self._enqueue(pvname, value, pulse_id)
+
+    def _enqueue(self, pvname, value, pulse_id):
+        if pulse_id is not None and pulse_id <= self._last_pulse_ids.get(pvname, -1):
+            self.dropped += 1
+            return
+
+        pending = self._pending.get(pvname)
+        if pending is not None:
+            if pulse_id is not None and pending[0] is not None and pulse_id <= pending[0]:
+                self.dropped += 1
+                return
+            self.coalesced += 1
+        self._pending[pvname] = (pulse_id, value)
+
+    def start(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = pipeline_workers.start_worker(__name__, self._run)
+
+    def stop(self):
+        pipeline_workers.stop_workers(__name__)
+
+    def _run(self, stop_event):
+        while not stop_event.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                _logger.exception("Error publishing PVs")
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            collectors = list(self._collectors.items())
+
+        for owner, collect in collectors:
+            try:
+                pending.update((pvname, (None, value)) for pvname, value in collect().items())
+            except Exception:
+                _logger.exception("Error collecting PV values of %s", owner)
+
+        new_pvnames = [pvname for pvname in pending if pvname not in self._pvs]
+        if new_pvnames:
+            self._pvs.update(zip(new_pvnames, create_thread_pvs(new_pvnames)))
+
+        budget = None if self.max_rate is None else max(1, int(self.max_rate * self.interval))
+        start = time.time()
+        for pvname, (pulse_id, value) in pending.items():
+            if pvname in self._last and _unchanged(self._last[pvname], value):
+                self.skipped += 1
+                continue
+
+            pv = self._pvs[pvname]
+            if not pv.connected or budget == 0:
+                # keep the value, unless a newer one arrived meanwhile, so that it goes out as soon as
+                # the PV connects or the rate allows
+                if pv.connected:
+                    self.deferred += 1
+                else:
+                    self.disconnected += 1
+                with self._lock:
+                    self._pending.setdefault(pvname, (pulse_id, value))
+                continue
+
+            pv.put(value)
+            self._last[pvname] = value
+            if pulse_id is not None:
+                self._last_pulse_ids[pvname] = pulse_id
+            self.puts += 1
+            if budget is not None:
+                budget -= 1
+
+        self.latency = time.time() - start
+        self.max_latency = max(self.max_latency, self.latency)
+
+    def stats(self):
+        return {
+            "puts": self.puts,
+            "skipped": self.skipped,
+            "disconnected": self.disconnected,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "deferred": self.deferred,
+            "latency": self.latency,
+            "max_latency": self.max_latency,
+        }
+
+
+def get_publisher(interval=None, max_rate=None):
+    global _publisher
+
+    with _publisher_lock:
+        if _publisher is None:
+            _publisher = PVPublisher()
+        if interval is not None:
+            _publisher.interval = interval
+        if max_rate is not None:
+            _publisher.max_rate = max_rate
+        _publisher.start()
+        return _publisher
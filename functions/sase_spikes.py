@@ -0,0 +1,73 @@
+import numpy as np
+import scipy.fft
+import scipy.signal
+
+
+def correlation_width(spectrum, step):
+    """FWHM of the autocorrelation of the spectrum fluctuations, in units of the axis `step`.
+
+    The autocorrelation is computed with a zero padded FFT, so it is not circular. Uncorrelated
+    pixel noise only adds to lag 0, so the peak is extrapolated from lags 1 and 2 where possible.
+    """
+    fluctuation = spectrum - spectrum.mean()
+    size = scipy.fft.next_fast_len(2 * len(spectrum))
+    power = np.abs(scipy.fft.rfft(fluctuation, size)) ** 2
+    autocorrelation = scipy.fft.irfft(power, size)[: len(spectrum)]
+    if autocorrelation[0] <= 0:
+        return np.nan
+
+    peak = 2 * autocorrelation[1] - autocorrelation[2]
+    autocorrelation /= peak if 0 < peak < autocorrelation[0] else autocorrelation[0]
+    autocorrelation[0] = 1.0
+    below = np.flatnonzero(autocorrelation < 0.5)
+    if len(below) == 0:
+        return np.nan
+    i = below[0]
+    # linear interpolation of the half maximum crossing between i - 1 and i
+    crossing = i - 1 + (autocorrelation[i - 1] - 0.5) / (autocorrelation[i - 1] - autocorrelation[i])
+    return 2 * crossing * step
+
+
+def analyse_spikes(spectrum, smoothed_spectrum, axis, prominence=0.1, max_spikes=32):
+    """Spikes of a single-shot SASE spectrum.
+
+    Spikes are found on the smoothed spectrum, as peaks with a prominence above `prominence` times
+    its amplitude. Their positions, FWHM widths and the correlation width are measured on the
+    unsmoothed `spectrum`, as the 51 point smoothing is wider than the spikes. Returns the number of
+    spikes, the positions and widths of the `max_spikes` most prominent spikes in axis units
+    (sorted by position, padded with nan to `max_spikes`) and the correlation width.
+    """
+    positions = np.full(max_spikes, np.nan)
+    widths = np.full(max_spikes, np.nan)
+    amplitude = smoothed_spectrum.max() - smoothed_spectrum.min()
+    step = abs(axis[-1] - axis[0]) / (len(axis) - 1)
+    if amplitude <= 0:
+        return 0, positions, widths, np.nan
+
+    peaks, properties = scipy.signal.find_peaks(smoothed_spectrum, prominence=prominence * amplitude)
+    count = len(peaks)
+    if count > max_spikes:
+        strongest = np.sort(np.argsort(properties["prominences"])[-max_spikes:])
+        peaks = peaks[strongest]
+        properties = {key: value[strongest] for key, value in properties.items()}
+
+    if len(peaks):
+        # the spike top is the maximum of the unsmoothed spectrum within the half maximum of the smoothed
+        # peak, its prominence is taken over the bases of the smoothed peak
+        _, _, left, right = scipy.signal.peak_widths(smoothed_spectrum, peaks, rel_height=0.5, prominence_data=(
+            properties["prominences"], properties["left_bases"], properties["right_bases"]))
+        tops = np.empty_like(peaks)
+        prominences = np.empty(len(peaks))
+        for k, (start, stop) in enumerate(zip(np.floor(left).astype(int), np.ceil(right).astype(int) + 1)):
+            tops[k] = start + np.argmax(spectrum[start:stop])
+            base = max(spectrum[properties["left_bases"][k] : tops[k] + 1].min(),
+                       spectrum[tops[k] : properties["right_bases"][k] + 1].min())
+            prominences[k] = spectrum[tops[k]] - base
+        # spikes lost in the noise of the unsmoothed spectrum keep a nan width
+        measured = np.flatnonzero(prominences > 0)
+        spike_widths = scipy.signal.peak_widths(spectrum, tops[measured], rel_height=0.5, prominence_data=(
+            prominences[measured], properties["left_bases"][measured], properties["right_bases"][measured]))[0]
+        positions[: len(peaks)] = axis[tops]
+        widths[measured] = spike_widths * step
+
+    return count, positions, widths, correlation_width(spectrum, step)
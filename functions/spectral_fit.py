@@ -0,0 +1,212 @@
+import math
+
+import numba
+import numpy as np
+
+N_PARAMETERS = 4
+
+# np.trapz was renamed in numpy 2
+_trapezoid = getattr(np, "trapezoid", None) or np.trapz
+
+
+@numba.njit(nogil=True, cache=True)
+def _gauss(x, offset, amplitude, center, sigma):
+    return offset + amplitude * math.exp(-((x - center) ** 2) / (2 * sigma**2))
+
+
+@numba.njit(nogil=True, cache=True)
+def _solve(matrix, vector):
+    # gaussian elimination with partial pivoting, for the small normal equations of the fit
+    n = vector.shape[0]
+    a = matrix.copy()
+    b = vector.copy()
+    for k in range(n):
+        pivot = k
+        for i in range(k + 1, n):
+            if abs(a[i, k]) > abs(a[pivot, k]):
+                pivot = i
+        if a[pivot, k] == 0.0:
+            return b, False
+        if pivot != k:
+            for j in range(n):
+                a[k, j], a[pivot, j] = a[pivot, j], a[k, j]
+            b[k], b[pivot] = b[pivot], b[k]
+        for i in range(k + 1, n):
+            factor = a[i, k] / a[k, k]
+            for j in range(k, n):
+                a[i, j] -= factor * a[k, j]
+            b[i] -= factor * b[k]
+    for k in range(n - 1, -1, -1):
+        for j in range(k + 1, n):
+            b[k] -= a[k, j] * b[j]
+        b[k] /= a[k, k]
+    return b, True
+
+
+@numba.njit(nogil=True, cache=True)
+def _normal_equations(x, y, p, jtj, jtr):
+    # fills J^T J and J^T r of the gaussian model at p and returns the sum of squared residuals
+    offset, amplitude, center, sigma = p[0], p[1], p[2], p[3]
+    jtj[:, :] = 0.0
+    jtr[:] = 0.0
+    jacobian = np.empty(N_PARAMETERS)
+    cost = 0.0
+    for i in range(x.shape[0]):
+        dx = x[i] - center
+        g = math.exp(-(dx**2) / (2 * sigma**2))
+        r = y[i] - (offset + amplitude * g)
+        jacobian[0] = 1.0
+        jacobian[1] = g
+        jacobian[2] = amplitude * g * dx / sigma**2
+        jacobian[3] = amplitude * g * dx**2 / sigma**3
+        for k in range(N_PARAMETERS):
+            jtr[k] += jacobian[k] * r
+            for m in range(k, N_PARAMETERS):
+                jtj[k, m] += jacobian[k] * jacobian[m]
+        cost += r * r
+    for k in range(N_PARAMETERS):
+        for m in range(k):
+            jtj[k, m] = jtj[m, k]
+    return cost
+
+
+@numba.njit(nogil=True, cache=True)
+def _cost(x, y, p):
+    cost = 0.0
+    for i in range(x.shape[0]):
+        r = y[i] - _gauss(x[i], p[0], p[1], p[2], p[3])
+        cost += r * r
+    return cost
+
+
+@numba.njit(nogil=True, cache=True)
+def levenberg_marquardt(x, y, p0, max_iterations):
+    # returns the fitted parameters, their standard errors and whether the fit converged
+    p = p0.copy()
+    jtj = np.empty((N_PARAMETERS, N_PARAMETERS))
+    jtr = np.empty(N_PARAMETERS)
+    damping = 1e-3
+    cost = _normal_equations(x, y, p, jtj, jtr)
+    converged = False
+
+    for _ in range(max_iterations):
+        augmented = jtj.copy()
+        for k in range(N_PARAMETERS):
+            augmented[k, k] += damping * max(jtj[k, k], 1e-300)
+        step, ok = _solve(augmented, jtr)
+        if not ok:
+            break
+
+        trial = p + step
+        trial_cost = _cost(x, y, trial)
+        if trial_cost < cost:
+            p = trial
+            damping = max(damping / 10, 1e-12)
+            previous_cost = cost
+            cost = _normal_equations(x, y, p, jtj, jtr)
+            if previous_cost - cost <= 1e-10 * previous_cost:
+                converged = True
+                break
+        else:
+            damping *= 10
+            if damping > 1e12:
+                break
+
+    # covariance as scipy's curve_fit without absolute_sigma: inv(J^T J) * cost / (n - parameters)
+    perr = np.full(N_PARAMETERS, np.nan)
+    dof = x.shape[0] - N_PARAMETERS
+    if dof > 0:
+        for k in range(N_PARAMETERS):
+            unit = np.zeros(N_PARAMETERS)
+            unit[k] = 1.0
+            column, ok = _solve(jtj, unit)
+            if ok and column[k] >= 0:
+                perr[k] = math.sqrt(column[k] * cost / dof)
+    p[3] = abs(p[3])
+    return p, perr, converged
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def _fit_many(x, profiles, p0, max_iterations, parameters, perrs):
+    for n in numba.prange(profiles.shape[0]):
+        parameters[n], perrs[n], _ = levenberg_marquardt(x, profiles[n], p0[n], max_iterations)
+
+
+def moment_estimate(profile, axis, offset=None, amplitude=None):
+    # the initial estimate of cam_server's gauss_fit_psss, also what it returns for skipped fits
+    offset = profile.min() if offset is None else offset
+    amplitude = profile.max() - offset if amplitude is None else amplitude
+    center = np.dot(axis, profile) / profile.sum()
+    standard_deviation = _trapezoid(profile - offset, x=axis) / (amplitude * np.sqrt(2 * np.pi))
+    return offset, amplitude, center, abs(standard_deviation)
+
+
+def caruana_estimate(profile, axis, offset=None, threshold=0.2):
+    """Closed-form gaussian estimate from a weighted parabola fit to the log of the profile.
+
+    Uses the points above `threshold` of the peak, weighted by their squared height (Guo's
+    weighting), and falls back to the moment estimate if the parabola does not open downwards.
+    """
+    offset = profile.min() if offset is None else offset
+    signal = profile - offset
+    peak = signal.max()
+    selected = signal > threshold * peak
+    if peak <= 0 or np.count_nonzero(selected) < 3:
+        return moment_estimate(profile, axis, offset)
+
+    x = axis[selected]
+    y = signal[selected]
+    x0 = x.mean()
+    weights = y**2
+    design = np.column_stack([np.ones_like(x), x - x0, (x - x0) ** 2])
+    a, b, c = np.linalg.lstsq(design * weights[:, None] ** 0.5, np.log(y) * weights**0.5, rcond=None)[0]
+    if not c < 0:
+        return moment_estimate(profile, axis, offset)
+
+    center = x0 - b / (2 * c)
+    return offset, np.exp(a - b**2 / (4 * c)), center, np.sqrt(-1 / (2 * c))
+
+
+def gauss_fit(profile, axis, **kwargs):
+    """Gaussian fit of a spectrum, a drop-in for cam_server's gauss_fit_psss that also returns errors.
+
+    Returns offset, amplitude, center, standard deviation and the standard errors of these four
+    parameters. With `skip=True` the moment estimate is returned, as gauss_fit_psss does.
+    """
+    if axis.shape[0] != profile.shape[0]:
+        raise RuntimeError("Invalid axis passed %d %d" % (axis.shape[0], profile.shape[0]))
+
+    # contiguous writable copies, so that the solver is compiled once whatever the pipelines pass,
+    # e.g. strided views of the spectrum and of the read-only energy axis
+    profile = np.array(profile, dtype=np.float64)
+    axis = np.array(axis, dtype=np.float64)
+    perr = np.full(N_PARAMETERS, np.nan)
+    if kwargs.get("skip", False):
+        return (*moment_estimate(profile, axis, kwargs.get("offset"), kwargs.get("amplitude")), perr)
+
+    p0 = np.array(caruana_estimate(profile, axis, kwargs.get("offset")), dtype=np.float64)
+    parameters, perr, _ = levenberg_marquardt(axis, profile, p0, kwargs.get("maxfev", 20))
+    if not np.all(np.isfinite(parameters)):
+        return (*p0, np.full(N_PARAMETERS, np.nan))
+    return (*parameters, perr)
+
+
+def gauss_fit_many(profiles, axis, max_iterations=20):
+    """Fits many spectra on a common axis in one call, returns (N, 4) parameters and errors."""
+    profiles = np.array(profiles, dtype=np.float64)
+    axis = np.array(axis, dtype=np.float64)
+    p0 = np.array([caruana_estimate(profile, axis) for profile in profiles], dtype=np.float64).reshape(-1, 4)
+    parameters = np.empty_like(p0)
+    perrs = np.empty_like(p0)
+    _fit_many(axis, profiles, p0, max_iterations, parameters, perrs)
+    return parameters, perrs
+
+
+def warm_up(many=False):
+    # compiles, or loads from the on-disk cache, the fit kernels with a synthetic spectrum. the
+    # parallel gauss_fit_many is only used offline and compiled on request
+    axis = np.linspace(-1.0, 1.0, 64)
+    profile = np.exp(-(axis**2) / 0.1)
+    gauss_fit(profile, axis)
+    if many:
+        gauss_fit_many(profile[None, :], axis)
@@ -0,0 +1,111 @@
+import argparse
+from logging import getLogger
+
+import numpy as np
+
+_logger = getLogger(__name__)
+
+ROWS_PER_BLOCK = 8
+
+# (map rows, frame rows) of the short shear maps that were already reported
+_short_maps = set()
+
+
+def _block_profiles(image, ymin, ymax, rows_per_block):
+    blocks = (ymax - ymin) // rows_per_block
+    stop = ymin + blocks * rows_per_block
+    profiles = np.asarray(image[ymin:stop], dtype=np.float64).reshape(blocks, rows_per_block, -1).sum(axis=1)
+    rows = ymin + (np.arange(blocks) + 0.5) * rows_per_block - 0.5
+    return rows, profiles
+
+
+def _subpixel_lag(correlation):
+    # lag of the correlation maximum, refined by a parabola through the maximum and its neighbours
+    size = len(correlation)
+    k = int(np.argmax(correlation))
+    left, center, right = correlation[k - 1], correlation[k], correlation[(k + 1) % size]
+    denominator = left - 2 * center + right
+    lag = k + (0.5 * (left - right) / denominator if denominator != 0 else 0.0)
+    return lag - size if lag > size / 2 else lag
+
+
+def fit_shear(image, ymin, ymax, order=2, rows_per_block=ROWS_PER_BLOCK):
+    """Polynomial in the row index of the horizontal shift of the spectral lines.
+
+    The ROI is cut into blocks of `rows_per_block` rows, the shift of each block profile to the
+    profile of the whole ROI is found by cross-correlation, and a polynomial of `order` (1 for a
+    tilt, 2 for tilt and curvature) is fitted to the shifts, weighted by the block intensities.
+    Returns the coefficients, highest power first, as np.polyval takes them.
+    """
+    rows, profiles = _block_profiles(image, ymin, ymax, rows_per_block)
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    reference = profiles.sum(axis=0)
+
+    size = 2 * profiles.shape[1]
+    spectra = np.fft.rfft(profiles, size, axis=1)
+    correlations = np.fft.irfft(spectra * np.conj(np.fft.rfft(reference, size)), size, axis=1)
+    shifts = np.array([_subpixel_lag(correlation) for correlation in correlations])
+
+    weights = np.sqrt(np.clip(profiles.std(axis=1), 0, None))
+    coefficients = np.polyfit(rows, shifts, order, w=weights)
+    # the shift at the ROI center is a translation of the whole spectrum, not a shear
+    coefficients[-1] -= np.polyval(coefficients, (ymin + ymax - 1) / 2)
+    return coefficients
+
+
+def shear_tables(coefficients, nrows):
+    # per row integer and fractional shifts, as the sheared projection kernels take them
+    shifts = np.polyval(coefficients, np.arange(nrows))
+    shift_int = np.floor(shifts).astype(np.int64)
+    shift_frac = shifts - shift_int
+    shift_int.flags.writeable = False
+    shift_frac.flags.writeable = False
+    return shift_int, shift_frac
+
+
+def save_shear_map(filename, coefficients, nrows):
+    shift_int, shift_frac = shear_tables(coefficients, nrows)
+    np.savez(filename, coefficients=coefficients, shift_int=shift_int, shift_frac=shift_frac)
+
+
+def load_shear_map(filename):
+    with np.load(filename) as f:
+        return shear_tables(f["coefficients"], len(f["shift_int"]))
+
+
+def shear_for_frame(shear, nrows):
+    # the shear tables if they cover the frame, None otherwise. a short map is logged once per frame
+    # height, not on every frame of every processing thread
+    if shear is None or len(shear[0]) >= nrows:
+        return shear
+    if (len(shear[0]), nrows) not in _short_maps:
+        _short_maps.add((len(shear[0]), nrows))
+        _logger.warning("Shear map for %d rows < image height %d", len(shear[0]), nrows)
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the tilt and curvature of the spectral lines of a camera.")
+    parser.add_argument("image", help="calibration image, npy file or HDF5 file with a stack of frames")
+    parser.add_argument("output", help="npz file for the shear map, the pipeline 'shear_map' setting")
+    parser.add_argument("--dataset", default="data/SARFE10-PSSS059/data", help="dataset of the frames in HDF5")
+    parser.add_argument("--roi", nargs=2, type=int, required=True, metavar=("YMIN", "YMAX"))
+    parser.add_argument("--order", type=int, default=2, help="1 for tilt, 2 for tilt and curvature")
+    args = parser.parse_args()
+
+    if args.image.endswith(".npy"):
+        image = np.load(args.image)
+    else:
+        import h5py
+
+        with h5py.File(args.image, "r") as f:
+            image = f[args.dataset][:].mean(axis=0)
+
+    coefficients = fit_shear(image, *args.roi, order=args.order)
+    shifts = np.polyval(coefficients, args.roi)
+    print(f"coefficients {coefficients}, shift at ymin {shifts[0]:.2f}, at ymax {shifts[1]:.2f} pixels")
+    save_shear_map(args.output, coefficients, image.shape[0])
+
+
+if __name__ == "__main__":
+    main()
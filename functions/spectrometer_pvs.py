@@ -0,0 +1,82 @@
+from collections import namedtuple
+from logging import getLogger
+from threading import Lock
+
+import epics
+import numpy as np
+
+_logger = getLogger(__name__)
+
+SpectrometerSettings = namedtuple("SpectrometerSettings", ["axis", "roi", "version"])
+
+_caches = {}
+_caches_lock = Lock()
+
+
+class SpectrometerPVCache:
+    """Energy axis and ROI of a spectrometer camera, kept up to date by Channel Access monitors.
+
+    The PVs are only read when the IOC posts a change. Each change produces a new immutable
+    `SpectrometerSettings` snapshot with an incremented version, which processing threads read
+    with a single attribute access and no Channel Access I/O. `pv_factory` builds the PVs and can
+    be replaced by a local stand-in that calls `callback`/`connection_callback` itself.
+    """
+
+    def __init__(self, camera_name, pv_factory=None):
+        self._lock = Lock()
+        self._axis = None
+        self._roi = (0, 0)
+        self.snapshot = SpectrometerSettings(None, self._roi, 0)
+
+        self._names = {
+            camera_name + ":SPECTRUM_X": "axis",
+            camera_name + ":SPC_ROI_YMIN": "ymin",
+            camera_name + ":SPC_ROI_YMAX": "ymax",
+        }
+
+        if pv_factory is None:
+            epics.ca.use_initial_context()
+            pv_factory = epics.PV
+
+        self._pvs = [
+            pv_factory(
+                pvname, callback=self._on_change, connection_callback=self._on_connection, auto_monitor=True
+            )
+            for pvname in self._names
+        ]
+
+    def _publish(self):
+        self.snapshot = SpectrometerSettings(self._axis, self._roi, self.snapshot.version + 1)
+
+    def _on_change(self, pvname=None, value=None, **kwargs):
+        with self._lock:
+            name = self._names[pvname]
+            if name == "axis":
+                axis = np.array(value, dtype=np.float64)
+                axis.flags.writeable = False
+                self._axis = axis
+            elif name == "ymin":
+                self._roi = (value, self._roi[1])
+            else:
+                self._roi = (self._roi[0], value)
+            self._publish()
+
+    def _on_connection(self, pvname=None, conn=None, **kwargs):
+        # frames are skipped while the energy axis is not connected, the ROI keeps its last value
+        if not conn and self._names[pvname] == "axis":
+            _logger.warning("Energy axis %s disconnected", pvname)
+            with self._lock:
+                self._axis = None
+                self._publish()
+
+    def disconnect(self):
+        for pv in self._pvs:
+            pv.disconnect()
+
+
+def get_pv_cache(camera_name):
+    # one cache per camera and process, so that function reloads reuse the existing monitors
+    with _caches_lock:
+        if camera_name not in _caches:
+            _caches[camera_name] = SpectrometerPVCache(camera_name)
+        return _caches[camera_name]
@@ -0,0 +1,262 @@
+import numba
+import numpy as np
+import scipy.ndimage
+import scipy.signal
+
+# smoothing of the spectrometer pipelines, savgol filter with 51 window size and 3rd order polynomial
+SAVGOL_WINDOW, SAVGOL_ORDER = 51, 3
+
+
+def _savgol_edge_matrices(window, order):
+    # savgol_filter's default "interp" mode fits a polynomial to the first and last window of samples,
+    # a linear map of those samples that is computed once here
+    t = np.arange(window)
+    vandermonde = np.vander(t, order + 1)
+    fit = vandermonde @ np.linalg.pinv(vandermonde)
+    half = window // 2
+    return fit[:half], fit[window - half:]
+
+
+_savgol_coefficients = scipy.signal.savgol_coeffs(SAVGOL_WINDOW, SAVGOL_ORDER)
+_savgol_left, _savgol_right = _savgol_edge_matrices(SAVGOL_WINDOW, SAVGOL_ORDER)
+
+
+def read_only(array):
+    # read-only view, frames and backgrounds are passed to the kernels as such, whatever their source,
+    # so that they always match the signatures compiled by warm_up
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+@numba.njit(nogil=True, cache=True)
+def project_roi(image, ymin, ymax, pedestal, out):
+    # column profile of image[ymin:ymax] - pedestal, reading the raw frame once
+    ncols = image.shape[1]
+    out[:] = 0.0
+    for i in range(ymin, ymax):
+        for j in range(ncols):
+            out[j] += image[i, j]
+    out -= (ymax - ymin) * pedestal
+    return out
+
+
+@numba.njit(nogil=True, cache=True)
+def project_roi_background(image, background, ymin, ymax, pedestal, out):
+    # column profile of image[ymin:ymax] - pedestal - background[ymin:ymax], without intermediate frames
+    ncols = image.shape[1]
+    out[:] = 0.0
+    for i in range(ymin, ymax):
+        for j in range(ncols):
+            out[j] += image[i, j] - background[i, j]
+    out -= (ymax - ymin) * pedestal
+    return out
+
+
+@numba.njit(nogil=True, parallel=True, cache=True)
+def _project_roi_clamped(image, background, ymin, ymax, n_blocks, out):
+    ncols = image.shape[1]
+    nrows = max(ymax - ymin, 0)
+    n_blocks = max(min(n_blocks, nrows), 1)
+    partial = np.zeros((n_blocks, ncols))
+    for block in numba.prange(n_blocks):
+        p = partial[block]
+        for i in range(ymin + block * nrows // n_blocks, ymin + (block + 1) * nrows // n_blocks):
+            a = image[i]
+            b = background[i]
+            for j in range(ncols):
+                p[j] += max(float(a[j]) - float(b[j]), 0.0)
+    out[:] = 0.0
+    for block in range(n_blocks):
+        out += partial[block]
+    return out
+
+
+def project_roi_clamped(image, background, ymin, ymax, out):
+    # column profile of max(image[ymin:ymax] - background[ymin:ymax], 0). each parallel task sums a
+    # block of rows into its own partial profile, which are reduced at the end, so no two threads
+    # add into the same array. the float64 sums are exact for integer frames. the number of blocks
+    # is the numba thread count of the calling thread, read here as it would keep the kernel out of
+    # the numba cache
+    return _project_roi_clamped(image, background, ymin, ymax, numba.get_num_threads(), out)
+
+
+@numba.njit(nogil=True, parallel=True, cache=True, fastmath=True)
+def _project_roi_moments(image, background, ymin, ymax, n_blocks, x_profile, y_profile, row_moments):
+    ncols = image.shape[1]
+    nrows = max(ymax - ymin, 0)
+    n_blocks = max(min(n_blocks, nrows), 1)
+    partial = np.zeros((n_blocks, ncols))
+    for block in numba.prange(n_blocks):
+        p = partial[block]
+        for i in range(ymin + block * nrows // n_blocks, ymin + (block + 1) * nrows // n_blocks):
+            a = image[i]
+            row_sum = 0.0
+            row_moment = 0.0
+            # a None background is resolved when the kernel is compiled, not per pixel
+            if background is None:
+                for j in range(ncols):
+                    v = float(a[j])
+                    p[j] += v
+                    row_sum += v
+                    row_moment += j * v
+            else:
+                b = background[i]
+                for j in range(ncols):
+                    v = max(float(a[j]) - float(b[j]), 0.0)
+                    p[j] += v
+                    row_sum += v
+                    row_moment += j * v
+            y_profile[i - ymin] = row_sum
+            row_moments[i - ymin] = row_moment
+    x_profile[:] = 0.0
+    for block in range(n_blocks):
+        x_profile += partial[block]
+
+
+def project_roi_moments(image, background, ymin, ymax, x_profile, y_profile, row_moments):
+    # x and y profiles of max(image - background, 0) in the rows ymin:ymax, or of the image if the
+    # background is None, and per row sum(x * I), all in one pass over the frame with the row blocks
+    # of project_roi_clamped
+    _project_roi_moments(image, background, ymin, ymax, numba.get_num_threads(), x_profile, y_profile, row_moments)
+
+
+def image_moments(x_profile, y_profile, row_moments, ymin=0):
+    """Intensity, centroid, standard deviations and tilt of an image from project_roi_moments.
+
+    Positions are in pixels, rows counted from row 0 of the frame. The tilt is the angle of the
+    major axis to the x axis, in radians.
+    """
+    total = x_profile.sum()
+    if not total > 0:
+        return total, np.nan, np.nan, np.nan, np.nan, np.nan
+    x = np.arange(len(x_profile))
+    y = ymin + np.arange(len(y_profile))
+    x_mean = np.dot(x, x_profile) / total
+    y_mean = np.dot(y, y_profile) / total
+    x_var = np.dot((x - x_mean) ** 2, x_profile) / total
+    y_var = np.dot((y - y_mean) ** 2, y_profile) / total
+    xy_cov = np.dot(y - y_mean, row_moments - x_mean * y_profile) / total
+    tilt = 0.5 * np.arctan2(2 * xy_cov, x_var - y_var)
+    return total, x_mean, y_mean, np.sqrt(x_var), np.sqrt(y_var), tilt
+
+
+def savgol_smooth(spectrum, out):
+    # scipy.signal.savgol_filter(spectrum, 51, 3) written into a preallocated float64 array
+    scipy.ndimage.convolve1d(spectrum, _savgol_coefficients, output=out, mode="constant")
+    half = SAVGOL_WINDOW // 2
+    np.dot(_savgol_left, spectrum[:SAVGOL_WINDOW], out=out[:half])
+    np.dot(_savgol_right, spectrum[-SAVGOL_WINDOW:], out=out[-half:])
+    return out
+
+
+@numba.njit(nogil=True, cache=True)
+def row_profile(image, row_step, col_step, out):
+    # sums of every col_step-th pixel of every row_step-th row, a cheap projection on the y axis
+    ncols = image.shape[1]
+    for i in range(out.shape[0]):
+        total = 0.0
+        for j in range(0, ncols, col_step):
+            total += image[i * row_step, j]
+        out[i] = total
+    return out
+
+
+@numba.njit(nogil=True, cache=True)
+def _shear_range(n, ncols):
+    # output columns c for which both row[c + n] and row[c + n + 1] exist
+    return max(0, -n), max(min(ncols, ncols - n - 1), max(0, -n))
+
+
+@numba.njit(nogil=True, cache=True)
+def project_roi_sheared(image, ymin, ymax, pedestal, shift_int, shift_frac, out):
+    # column profile of image[ymin:ymax] - pedestal with each row moved left by its shift, the
+    # fractional part split linearly between two columns, in one pass and without a resampled image:
+    # out[c] += (1 - f) * row[c + n] + f * row[c + n + 1]
+    ncols = image.shape[1]
+    out[:] = 0.0
+    for i in range(ymin, ymax):
+        n, f = shift_int[i], shift_frac[i]
+        first, last = _shear_range(n, ncols)
+        # slices keep the inner loop free of negative index handling, so that it vectorizes
+        a = image[i, first + n:last + n]
+        b = image[i, first + n + 1:last + n + 1]
+        o = out[first:last]
+        for c in range(o.shape[0]):
+            o[c] += (1.0 - f) * a[c] + f * b[c] - pedestal
+        # columns that only get one of the two pixels
+        if 0 <= -n - 1 < ncols:
+            out[-n - 1] += f * (image[i, 0] - pedestal)
+        if 0 <= ncols - n - 1 < ncols:
+            out[ncols - n - 1] += (1.0 - f) * (image[i, ncols - 1] - pedestal)
+    return out
+
+
+@numba.njit(nogil=True, cache=True)
+def project_roi_sheared_clamped(image, background, ymin, ymax, shift_int, shift_frac, out):
+    # as project_roi_sheared, for max(image - background, 0) as the PMOS pipeline integrates it
+    ncols = image.shape[1]
+    out[:] = 0.0
+    for i in range(ymin, ymax):
+        n, f = shift_int[i], shift_frac[i]
+        first, last = _shear_range(n, ncols)
+        a = image[i, first + n:last + n]
+        b = image[i, first + n + 1:last + n + 1]
+        a_background = background[i, first + n:last + n]
+        b_background = background[i, first + n + 1:last + n + 1]
+        o = out[first:last]
+        for c in range(o.shape[0]):
+            o[c] += (1.0 - f) * max(float(a[c]) - float(a_background[c]), 0.0) + f * max(
+                float(b[c]) - float(b_background[c]), 0.0)
+        if 0 <= -n - 1 < ncols:
+            out[-n - 1] += f * max(float(image[i, 0]) - float(background[i, 0]), 0.0)
+        if 0 <= ncols - n - 1 < ncols:
+            out[ncols - n - 1] += (1.0 - f) * max(float(image[i, ncols - 1]) - float(background[i, ncols - 1]), 0.0)
+    return out
+
+
+def warm_up(kernels, image_dtypes=(np.uint16,), background_dtypes=(), pedestals=(0,)):
+    """Compiles, or loads from the on-disk cache, the given kernels for the frame types of a pipeline.
+
+    numba compiles one specialization per argument types, and each one takes seconds on a cold
+    cache, so pipelines list only the kernels and dtypes their config uses. Kernels that take a
+    background are run with each of `background_dtypes`, where None stands for frames without
+    background, the others with each pedestal. Frames, backgrounds and shear tables are read-only,
+    like the ones of the pipelines.
+    """
+    nrows, ncols = 8, 64
+    out = np.empty(ncols, dtype=np.float64)
+    y_profile, row_moments = np.empty(nrows), np.empty(nrows)
+    shift_int = read_only(np.zeros(nrows, dtype=np.int64))
+    shift_frac = read_only(np.zeros(nrows, dtype=np.float64))
+
+    image_calls = {
+        row_profile: lambda image, pedestal: row_profile(image, 2, 2, np.empty(nrows // 2)),
+        project_roi: lambda image, pedestal: project_roi(image, 0, nrows, pedestal, out),
+        project_roi_sheared: lambda image, pedestal: project_roi_sheared(
+            image, 0, nrows, pedestal, shift_int, shift_frac, out),
+    }
+    background_calls = {
+        project_roi_background: lambda image, background, pedestal: project_roi_background(
+            image, background, 0, nrows, pedestal, out),
+        project_roi_clamped: lambda image, background, pedestal: project_roi_clamped(image, background, 0, nrows, out),
+        project_roi_moments: lambda image, background, pedestal: project_roi_moments(
+            image, background, 0, nrows, out, y_profile, row_moments),
+        project_roi_sheared_clamped: lambda image, background, pedestal: project_roi_sheared_clamped(
+            image, background, 0, nrows, shift_int, shift_frac, out),
+    }
+
+    for image_dtype in image_dtypes:
+        image = read_only(np.ones((nrows, ncols), dtype=image_dtype))
+        for kernel in kernels:
+            for pedestal in pedestals:
+                if kernel in image_calls:
+                    image_calls[kernel](image, pedestal)
+                if kernel in background_calls:
+                    for background_dtype in background_dtypes:
+                        if background_dtype is None and kernel is not project_roi_moments:
+                            continue
+                        background = None
+                        if background_dtype is not None:
+                            background = read_only(np.zeros((nrows, ncols), background_dtype))
+                        background_calls[kernel](image, background, pedestal)
@@ -0,0 +1,9 @@
+import os
+import sys
+
+# more numba threads than the test machine may have cores, so that the parallel kernels are
+# tested with several row blocks. it has to be set before numba is imported
+os.environ.setdefault("NUMBA_NUM_THREADS", "4")
+
+# the pipeline helpers are uploaded to cam_server as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
@@ -0,0 +1,16 @@
+class FakePV:
+    """Local stand-in for epics.PV, the tests post monitor and connection events themselves."""
+
+    def __init__(self, pvname, callback=None, connection_callback=None, auto_monitor=True):
+        self.pvname = pvname
+        self.callback = callback
+        self.connection_callback = connection_callback
+
+    def post(self, value):
+        self.callback(pvname=self.pvname, value=value)
+
+    def connect(self, conn):
+        self.connection_callback(pvname=self.pvname, conn=conn)
+
+    def disconnect(self):
+        pass
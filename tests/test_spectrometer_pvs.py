@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("epics")
+from fake_pv import FakePV
+from spectrometer_pvs import SpectrometerPVCache
+
+CAMERA = "SARFE10-PSSS059"
+
+
+@pytest.fixture
+def cache():
+    cache = SpectrometerPVCache(CAMERA, pv_factory=FakePV)
+    cache.pvs = {pv.pvname.split(":")[-1]: pv for pv in cache._pvs}
+    return cache
+
+
+def test_initial_snapshot(cache):
+    assert cache.snapshot.axis is None
+    assert cache.snapshot.roi == (0, 0)
+    assert cache.snapshot.version == 0
+
+
+def test_each_change_replaces_snapshot(cache):
+    snapshots = [cache.snapshot]
+    cache.pvs["SPECTRUM_X"].post(np.linspace(9000, 9100, 16))
+    snapshots.append(cache.snapshot)
+    cache.pvs["SPC_ROI_YMIN"].post(700)
+    snapshots.append(cache.snapshot)
+    cache.pvs["SPC_ROI_YMAX"].post(1400)
+    snapshots.append(cache.snapshot)
+
+    assert [snapshot.version for snapshot in snapshots] == [0, 1, 2, 3]
+    assert len({id(snapshot) for snapshot in snapshots}) == len(snapshots)
+    # earlier snapshots are not modified by later changes
+    assert snapshots[1].roi == (0, 0)
+    assert snapshots[2].roi == (700, 0)
+    assert snapshots[3].roi == (700, 1400)
+    np.testing.assert_array_equal(snapshots[3].axis, np.linspace(9000, 9100, 16))
+
+
+def test_axis_is_read_only(cache):
+    value = [9000.0, 9001.0, 9002.0]
+    cache.pvs["SPECTRUM_X"].post(value)
+    axis = cache.snapshot.axis
+    assert axis.dtype == np.float64
+    assert not axis.flags.writeable
+    with pytest.raises(ValueError):
+        axis[0] = 0.0
+
+
+def test_axis_disconnect_keeps_roi(cache):
+    cache.pvs["SPECTRUM_X"].post(np.arange(8.0))
+    cache.pvs["SPC_ROI_YMIN"].post(10)
+    cache.pvs["SPC_ROI_YMAX"].post(20)
+    version = cache.snapshot.version
+
+    cache.pvs["SPECTRUM_X"].connect(False)
+    assert cache.snapshot.axis is None
+    assert cache.snapshot.roi == (10, 20)
+    assert cache.snapshot.version == version + 1
+
+    cache.pvs["SPECTRUM_X"].post(np.arange(8.0))
+    assert cache.snapshot.axis is not None
+    assert cache.snapshot.version == version + 2
+
+
+def test_roi_disconnect_keeps_snapshot(cache):
+    cache.pvs["SPECTRUM_X"].post(np.arange(8.0))
+    snapshot = cache.snapshot
+    cache.pvs["SPC_ROI_YMIN"].connect(False)
+    cache.pvs["SPECTRUM_X"].connect(True)
+    assert cache.snapshot is snapshot
@@ -0,0 +1,67 @@
+import numba
+import numpy as np
+import pytest
+
+from spectrum_kernels import project_roi_clamped, project_roi_moments
+
+# PMOS132-2D frame size
+NROWS, NCOLS = 2160, 2560
+ROIS = [(0, NROWS), (700, 1400), (3, 2157), (0, 1), (NROWS - 1, NROWS), (5, 5)]
+THREADS = [1, 2, 4]
+
+
+@pytest.fixture(scope="module")
+def image():
+    return np.random.default_rng(0).integers(0, 4096, size=(NROWS, NCOLS), dtype=np.uint16)
+
+
+@pytest.fixture(scope="module", params=[np.uint16, np.float32, None])
+def background(request):
+    rng = np.random.default_rng(1)
+    if request.param is None:
+        return None
+    if request.param == np.float32:
+        # quarter counts, so that the float64 sums are exact in any order
+        return (rng.integers(360, 440, size=(NROWS, NCOLS)) / 4).astype(np.float32)
+    return rng.integers(90, 110, size=(NROWS, NCOLS), dtype=np.uint16)
+
+
+@pytest.fixture(scope="module")
+def clamped(image, background):
+    # serial reference, max(image - background, 0) per pixel
+    if background is None:
+        return image.astype(np.float64)
+    return np.maximum(image.astype(np.float64) - background.astype(np.float64), 0.0)
+
+
+@pytest.fixture(params=THREADS)
+def threads(request):
+    if request.param > numba.config.NUMBA_NUM_THREADS:
+        pytest.skip(f"numba is limited to {numba.config.NUMBA_NUM_THREADS} threads")
+    previous = numba.get_num_threads()
+    numba.set_num_threads(request.param)
+    yield request.param
+    numba.set_num_threads(previous)
+
+
+@pytest.mark.parametrize("ymin, ymax", ROIS)
+def test_project_roi_clamped(image, background, clamped, threads, ymin, ymax):
+    if background is None:
+        pytest.skip("project_roi_clamped needs a background")
+    out = np.full(NCOLS, np.nan)
+    result = project_roi_clamped(image, background, ymin, ymax, out)
+    assert result is out
+    assert np.array_equal(result, clamped[ymin:ymax].sum(axis=0))
+
+
+@pytest.mark.parametrize("ymin, ymax", ROIS)
+def test_project_roi_moments(image, background, clamped, threads, ymin, ymax):
+    x_profile = np.full(NCOLS, np.nan)
+    y_profile = np.full(ymax - ymin, np.nan)
+    row_moments = np.full(ymax - ymin, np.nan)
+    project_roi_moments(image, background, ymin, ymax, x_profile, y_profile, row_moments)
+
+    roi = clamped[ymin:ymax]
+    assert np.array_equal(x_profile, roi.sum(axis=0))
+    assert np.array_equal(y_profile, roi.sum(axis=1))
+    assert np.array_equal(row_moments, roi @ np.arange(NCOLS, dtype=np.float64))
@@ -0,0 +1,97 @@
+import importlib.util
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("epics")
+pytest.importorskip("cam_server")
+import dark_background
+import pv_publisher
+import spectral_fit
+import spectral_shear
+import spectrometer_pvs
+import spectrum_kernels
+from fake_pv import FakePV
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+NROWS, NCOLS = 200, 256
+
+
+def load_pipeline(path, name):
+    # a fresh module per test, so that every test initializes its own setup
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def signatures():
+    return {
+        f"{module.__name__}.{name}": len(function.signatures)
+        for module in (spectrum_kernels, spectral_fit, dark_background)
+        for name, function in vars(module).items()
+        if hasattr(function, "signatures")
+    }
+
+
+def frame(rng, dark=False):
+    # a spectral band in rows 50 to 150 on a noisy pedestal, as the cameras send it
+    x = np.arange(NCOLS)
+    signal = np.zeros((NROWS, NCOLS))
+    if not dark:
+        signal[50:150] = 20 * np.exp(-((x - 128) ** 2) / (2 * 20**2))
+    image = rng.poisson(signal + 5).astype(np.uint16)
+    image.flags.writeable = False
+    return image
+
+
+@pytest.fixture
+def camera(request):
+    # energy axis and ROI PVs of a fake camera, read-only axis as from the real monitors
+    camera_name = f"TEST-{request.node.name}"
+    cache = spectrometer_pvs.SpectrometerPVCache(camera_name, pv_factory=FakePV)
+    values = {":SPECTRUM_X": np.linspace(9000, 9100, NCOLS), ":SPC_ROI_YMIN": 40, ":SPC_ROI_YMAX": 160}
+    for pv in cache._pvs:
+        pv.post(values[pv.pvname[len(camera_name):]])
+    spectrometer_pvs._caches[camera_name] = cache
+    yield camera_name
+    spectrometer_pvs._caches.pop(camera_name)
+    pv_publisher.get_publisher().stop()
+
+
+@pytest.fixture
+def shear_map(tmp_path):
+    filename = str(tmp_path / "shear.npz")
+    spectral_shear.save_shear_map(filename, np.array([1e-4, 0.02, -1.0]), NROWS)
+    return filename
+
+
+CASES = {
+    "background": {"image_background_enable": True},
+    "shear": {"image_background_enable": True, "shear": True},
+    "online": {"online_background": "mean", "events": "EVENTS", "dark_event": 25},
+}
+
+
+@pytest.mark.parametrize("path, name", [("PSSS059/psss.py", "psss"), ("PMOS132-2D/pmos132-2D.py", "pmos132_2D")])
+@pytest.mark.parametrize("case", CASES)
+def test_first_frames_do_not_compile(camera, shear_map, path, name, case):
+    pipeline = load_pipeline(path, name)
+    parameters = {"camera_name": camera, "name": camera, "pixel_bkg": 1, "image_background": "BKG"}
+    parameters.update(CASES[case])
+    if parameters.pop("shear", False):
+        parameters["shear_map"] = shear_map
+
+    pipeline.setup = pipeline.initialize(parameters)
+    compiled = signatures()
+
+    rng = np.random.default_rng(0)
+    events = np.zeros(256, dtype=bool)
+    bsdata = {"EVENTS": events}
+    for dark in (True, False):
+        events[25] = dark
+        frame_parameters = dict(parameters, background_data=np.full((NROWS, NCOLS), 4.0, dtype=np.float32))
+        processed = pipeline.process_image(frame(rng, dark), 0, 0, None, None, frame_parameters, bsdata)
+    assert np.isfinite(processed[f"{camera}:SPECTRUM_CENTER"])
+    assert signatures() == compiled